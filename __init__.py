@@ -3,11 +3,45 @@
 # the full copyright notices and license terms.
 from trytond.pool import Pool
 from . import aeat
+from . import country
+from . import ir
+from . import routes
+
+__all__ = ['register', 'routes']
 
 
 def register():
     Pool.register(
         aeat.Report,
         aeat.ReportAccount,
+        aeat.ReportProgress,
+        aeat.ReportCertificatePart,
         aeat.ReportParty,
+        aeat.DonorHistory,
+        aeat.DeductionRate,
+        aeat.ReportError,
+        aeat.ReportSummary,
+        aeat.CalculateAllResult,
+        aeat.ImportReportStart,
+        aeat.ImportReportResult,
+        aeat.CorrectReportStart,
+        aeat.CertificatesStart,
+        aeat.ExportStart,
+        aeat.PreviewStart,
+        aeat.PreviewSummary,
+        aeat.PreviewDonor,
+        country.Subdivision,
+        country.Zip,
+        ir.Cron,
         module='aeat_182', type_='model')
+    Pool.register(
+        aeat.CalculateAll,
+        aeat.ImportReport,
+        aeat.CorrectReport,
+        aeat.Certificates,
+        aeat.Export,
+        aeat.Preview,
+        module='aeat_182', type_='wizard')
+    Pool.register(
+        aeat.DonorCertificate,
+        module='aeat_182', type_='report')
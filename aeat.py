@@ -2,22 +2,66 @@
 # This file is part of aeat_182 module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
+import bisect
+import codecs
+import csv
+import datetime
+import gzip
+import heapq
+import io
+import logging
+import shutil
+import string
+import time
 import unicodedata
 import sys
+import tempfile
+import zipfile
+from collections import defaultdict
 from decimal import Decimal
 from retrofix import aeat182
-from sql import Null
+from retrofix.exception import RetrofixException
+from sql import Column, Literal, Null
+from sql.operators import Equal
+from stdnum.es import nif as es_nif
 from retrofix.record import Record, write as retrofix_write
-from sql.aggregate import Sum
-from trytond.model import ModelSQL, ModelView, fields, Workflow, Unique
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import CurrentTimestamp
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.filestore import filestore
+from trytond.model import (ModelSQL, ModelView, fields, Workflow, Unique,
+    Exclude)
+from trytond.model.exceptions import AccessError
+from trytond.model.modelsql import convert_from
+from trytond.wizard import (Wizard, StateAction, StateTransition, StateView,
+    Button)
 from trytond.pool import Pool
+from trytond.rpc import RPC
 from trytond.transaction import Transaction
+from trytond.tools import grouped_slice, reduce_ids, slugify
 from trytond.pyson import And, Bool, Eval, Not
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
+from trytond.modules.company import CompanyReport
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+from .instrumentation import instrument, phase
+from .store import get_prefix, open_file, set_file
 
 
-__all__ = ['Report', 'ReportAccount', 'ReportParty']
+__all__ = ['Report', 'ReportAccount', 'ReportProgress',
+    'ReportCertificatePart', 'ReportParty',
+    'DonorHistory', 'CalculateAllResult', 'CalculateAll', 'ImportReportStart',
+    'ImportReportResult', 'ImportReport', 'CorrectReportStart',
+    'CorrectReport', 'ReportError', 'ReportSummary', 'DeductionRate',
+    'DonorCertificate', 'CertificatesStart', 'Certificates', 'ExportStart',
+    'Export', 'PreviewStart', 'PreviewSummary', 'PreviewDonor', 'Preview']
+logger = logging.getLogger(__name__)
 KEY = [
     ('A', 'A. Donations not included in the priority activities or '
         'sponsorship programs established by Law on State Budget'),
@@ -60,9 +104,88 @@ DONATION_TYPE = [
     ('C', 'Complementary'),
     ('S', 'Substitutive')
     ]
+# Province codes of the donors, 99 is used for non-residents
+PROVINCE_CODES = frozenset(['%02d' % i for i in range(1, 53)] + ['99'])
+# INE province code of the ISO 3166-2 codes of the Spanish provinces and of
+# the autonomous communities and cities with a single province
+ISO_PROVINCE_CODES = {
+    'ES-VI': '01', 'ES-AB': '02', 'ES-A': '03', 'ES-AL': '04', 'ES-AV': '05',
+    'ES-BA': '06', 'ES-PM': '07', 'ES-IB': '07', 'ES-B': '08', 'ES-BU': '09',
+    'ES-CC': '10', 'ES-CA': '11', 'ES-CS': '12', 'ES-CR': '13', 'ES-CO': '14',
+    'ES-C': '15', 'ES-CU': '16', 'ES-GI': '17', 'ES-GR': '18', 'ES-GU': '19',
+    'ES-SS': '20', 'ES-H': '21', 'ES-HU': '22', 'ES-J': '23', 'ES-LE': '24',
+    'ES-L': '25', 'ES-LO': '26', 'ES-RI': '26', 'ES-LU': '27', 'ES-M': '28',
+    'ES-MD': '28', 'ES-MA': '29', 'ES-MU': '30', 'ES-MC': '30', 'ES-NA': '31',
+    'ES-NC': '31', 'ES-OR': '32', 'ES-O': '33', 'ES-AS': '33', 'ES-P': '34',
+    'ES-GC': '35', 'ES-PO': '36', 'ES-SA': '37', 'ES-TF': '38', 'ES-S': '39',
+    'ES-CB': '39', 'ES-SG': '40', 'ES-SE': '41', 'ES-SO': '42', 'ES-T': '43',
+    'ES-TE': '44', 'ES-TO': '45', 'ES-V': '46', 'ES-VA': '47', 'ES-BI': '48',
+    'ES-ZA': '49', 'ES-Z': '50', 'ES-CE': '51', 'ES-ML': '52',
+    }
+
+
+# Characters accepted by the AEAT in the alphanumeric fields: the letters
+# without accents but Ñ and Ç, the digits, the space and some punctuation.
+# The lower case letters are converted to upper case in the file and the line
+# breaks separate its records.
+AEAT_CHARSET = frozenset(string.ascii_letters + string.digits + ' ÑñÇç'
+    + "&'(),-./:;" + '\r\n')
+
+
+class _AEATCharsetTable(dict):
+    """
+    Translation table from unicode to AEAT_CHARSET keeping the length.
+
+    Accented letters are replaced by their base letter, combining marks are
+    removed and the other characters are replaced by a space.
+    The translation of each character is computed once.
+    """
+
+    def __missing__(self, key):
+        char = chr(key)
+        if char not in AEAT_CHARSET:
+            if unicodedata.combining(char):
+                char = ''
+            else:
+                char = ''.join(c for c in unicodedata.normalize('NFD', char)
+                    if not unicodedata.combining(c))
+                if char not in AEAT_CHARSET:
+                    char = ' '
+        self[key] = char
+        return char
+
+
+_aeat_charset_table = _AEATCharsetTable()
+# ISO-8859-1 characters are translated at once on the encoded bytes
+_remove_accents_bytes = bytes(
+    ord(_aeat_charset_table[i]) for i in range(256))
+_aeat_charset_bytes = bytes(
+    ord(_aeat_charset_table[i].upper()) for i in range(256))
+
+
+def _aeat_charset_errors(error):
+    "Encoding error handler translating the characters out of ISO-8859-1"
+    return (error.object[error.start:error.end].translate(
+            _aeat_charset_table), error.end)
+
+
+codecs.register_error('aeat_182', _aeat_charset_errors)
+
+
+def aeat_encode(unicode_string, upper=True):
+    "Encode unicode_string in ISO-8859-1 using only AEAT_CHARSET"
+    return unicodedata.normalize('NFC', unicode_string).encode(
+        'iso-8859-1', 'aeat_182').translate(
+        _aeat_charset_bytes if upper else _remove_accents_bytes)
 
 
 def remove_accents(unicode_string):
+    '''
+    Return unicode_string with only the characters of AEAT_CHARSET.
+    The accents are removed but from Ñ and Ç, and the characters without an
+    equivalent in AEAT_CHARSET, like Ł, € or @, are replaced by a space.
+    Before only the accents were removed and those characters were kept.
+    '''
     str_ = str if sys.version_info < (3, 0) else bytes
     unicode_ = str if sys.version_info < (3, 0) else str
     if isinstance(unicode_string, str_):
@@ -78,13 +201,22 @@ def remove_accents(unicode_string):
     if not isinstance(unicode_string, unicode_):
         return unicode_string
 
-    unicode_string_nfd = ''.join(
-        (c for c in unicodedata.normalize('NFD', unicode_string)
-            if (unicodedata.category(c) != 'Mn'
-                or c in ('\\u0327', '\\u0303'))  # Avoids normalize ç and ñ
-            ))
-    # It converts nfd to nfc to allow unicode.decode()
-    return unicodedata.normalize('NFC', unicode_string_nfd)
+    return aeat_encode(unicode_string, upper=False).decode('iso-8859-1')
+
+
+def _order_totals(name):
+    "Return the order method of the total name of aeat.182.report"
+    def order_field(tables):
+        Report = Pool().get('aeat.182.report')
+        table, _ = tables[None]
+        if 'aeat_182_totals' not in tables:
+            totals = Report._get_totals_query()
+            tables['aeat_182_totals'] = {
+                None: (totals, totals.report == table.id),
+                }
+        totals, _ = tables['aeat_182_totals'][None]
+        return [Report._get_totals_column(totals, name)]
+    return staticmethod(order_field)
 
 
 class Report(Workflow, ModelSQL, ModelView):
@@ -112,9 +244,10 @@ class Report(Workflow, ModelSQL, ModelView):
                 'invisible': True,
                 }), 'get_currency')
     fiscalyear = fields.Many2One('account.fiscalyear', 'Fiscal Year',
-        required=True, states={
+        states={
+            'required': ~Eval('imported', False),
             'readonly': Eval('state') != 'draft',
-            }, depends=['state'])
+            }, depends=['state', 'imported'])
     fiscalyear_code = fields.Integer('Fiscal Year Code',
         states={
             'required': True,
@@ -162,11 +295,20 @@ class Report(Workflow, ModelSQL, ModelView):
             'invisible': Eval('type') == 'N',
             }, depends=['state', 'type'])
     total_number_of_donor_records = fields.Function(fields.Integer(
-        'Total number of donor records'), 'get_totals')
+        'Total number of donor records'), 'get_totals',
+        searcher='search_totals')
     amount_of_donations = fields.Function(fields.Numeric('Amount of donations',
             digits=(16, Eval('currency_digits', 2)),
-            depends=['currency_digits']), 'get_totals')
+            depends=['currency_digits']), 'get_totals',
+        searcher='search_totals')
     date = fields.Date('Date', readonly=True)
+    last_calculation = fields.Timestamp('Last Calculation', readonly=True)
+    imported = fields.Boolean('Imported', readonly=True,
+        help='The report has been imported from an AEAT 182 file.')
+    stats = fields.Text('Statistics', readonly=True,
+        help='The time, queries and rows of the phases of the last '
+        'calculation or file generation when the instrumentation is '
+        'enabled.')
     contact_name = fields.Char('Name And Surname Contact', size=40,
         states={
             'readonly': ~Eval('state').in_(['draft', 'calculated']),
@@ -175,82 +317,195 @@ class Report(Workflow, ModelSQL, ModelView):
         'Party Donations', states={
             'readonly': Eval('state') != 'calculated',
             }, depends=['state'])
+    summary = fields.One2Many('aeat.182.report.summary', 'report', 'Summary',
+        readonly=True)
     total_sheets = fields.Function(fields.Integer('Total Sheets'),
-        'get_total_sheets')
+        'get_totals', searcher='search_totals')
     state = fields.Selection([
             ('draft', 'Draft'),
+            ('calculating', 'Calculating'),
             ('calculated', 'Calculated'),
+            ('generating', 'Generating'),
             ('done', 'Done'),
             ('cancelled', 'Cancelled')
             ], 'State', readonly=True)
-    file_ = fields.Binary('File', filename='filename', states={
+    processed_donors = fields.Function(fields.Integer('Processed Donors',
+            states={
+                'invisible': ~Eval('state').in_(['calculating', 'generating']),
+                }, depends=['state']), 'get_progress')
+    total_donors = fields.Function(fields.Integer('Total Donors',
+            states={
+                'invisible': ~Eval('state').in_(['calculating', 'generating']),
+                }, depends=['state']), 'get_progress')
+    file_ = fields.Binary('File', filename='filename', file_id='file_id',
+        states={
             'invisible': Eval('state') != 'done',
-            })
+            }, depends=['state'])
+    file_id = fields.Char('File ID', readonly=True)
     filename = fields.Function(fields.Char("File Name"),
         'get_filename')
+    archive = fields.Binary('Archive', filename='archive_filename',
+        file_id='archive_id', readonly=True, states={
+            'invisible': ~Eval('archive_id'),
+            }, depends=['archive_id'])
+    archive_id = fields.Char('Archive ID', readonly=True)
+    archive_filename = fields.Function(fields.Char("Archive File Name"),
+        'get_filename')
+    certificates = fields.Binary('Certificates',
+        filename='certificates_filename', file_id='certificates_id',
+        readonly=True, states={
+            'invisible': ~Eval('certificates_id'),
+            }, depends=['certificates_id'])
+    certificates_id = fields.Char('Certificates ID', readonly=True)
+    certificates_filename = fields.Function(
+        fields.Char("Certificates File Name"), 'get_filename')
+    export = fields.Binary('Export', filename='export_filename',
+        file_id='export_id', readonly=True, states={
+            'invisible': ~Eval('export_id'),
+            }, depends=['export_id'])
+    export_id = fields.Char('Export ID', readonly=True)
+    export_format = fields.Selection([
+            (None, ''),
+            ('csv', 'CSV'),
+            ('xlsx', 'XLSX'),
+            ], 'Export Format', readonly=True)
+    export_filename = fields.Function(fields.Char("Export File Name"),
+        'get_filename')
     accounts = fields.Many2Many('aeat.182.report.account', 'report', 'account',
         'Accounts')
     periods_for_pluriannual_donation = fields.Integer(
         'Immediately Preceding Tax Periods for Pluriannual Donation')
-    donation_amount_threshold = fields.Numeric('Donation Amount Threshold for '
-        'the Applying of the Second Scale of Deduction',
-        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'])
-    first_less_physical = fields.Numeric('Deductible Percentage of First '
-        'Donation of Less Amount of Physical Person',
-        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'])
-    first_greater_physical = fields.Numeric('Deductible Percentage of First '
-        'Donation of Greater Amount of Physical Person',
-        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'])
-    pluriannual_physical = fields.Numeric('Deductible Percentage of '
-        'Pluriannual Donation of Physical Person',
-        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'])
-    first_less_artificial = fields.Numeric('Deductible Percentage of First '
-        'Donation of Less Amount of Artificial Person',
-        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'])
-    first_greater_artificial = fields.Numeric('Deductible Percentage of First '
-        'Donation of Greater Amount of Artificial Person',
-        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'])
-    pluriannual_artificial = fields.Numeric('Deductible Percentage of '
-        'Pluriannual Donation of Artificial Person',
-        digits=(16, Eval('currency_digits', 2)), depends=['currency_digits'])
+    deduction_rates = fields.Function(fields.One2Many(
+            'aeat.182.deduction.rate', None, 'Deduction Rates'),
+        'get_deduction_rates')
+    _subdivision_code_cache = Cache('aeat.182.report.subdivision_code',
+        context=False)
+    _progress_marks = {}
 
     @classmethod
     def __setup__(cls):
         super(cls, Report).__setup__()
         t = cls.__table__()
         cls._sql_constraints += [
-            ('code_uniq', Unique(t, t.fiscalyear, t.company),
+            ('normal_uniq', Exclude(t, (t.fiscalyear, Equal),
+                    (t.company, Equal), where=t.type == 'N'),
                 'Report must be unique by fiscalyear and company'),
         ]
         cls._buttons.update({
                 'draft': {
-                    'invisible': ~Eval('state').in_(['calculated',
-                            'cancelled']),
+                    'invisible': ~Eval('state').in_(['calculating',
+                            'calculated', 'generating', 'cancelled']),
                     'icon': 'tryton-go-previous',
                     },
                 'calculate': {
                     'invisible': ~Eval('state').in_(['draft']),
                     'icon': 'tryton-go-next',
                     },
+                'recalculate': {
+                    'invisible': ~Eval('state').in_(['calculated']),
+                    'icon': 'tryton-refresh',
+                    },
                 'process': {
                     'invisible': ~Eval('state').in_(['calculated']),
                     'icon': 'tryton-ok',
                     },
+                'update_donor_history': {
+                    'invisible': Eval('state') != 'done',
+                    'icon': 'tryton-refresh',
+                    },
                 'cancel': {
                     'invisible': Eval('state').in_(['cancelled']),
                     'icon': 'tryton-cancel',
                     },
+                'check_lines': {
+                    'invisible': ~Eval('state').in_(['calculated', 'done']),
+                    'icon': 'tryton-ok',
+                    },
+                'correct': {
+                    'invisible': ((Eval('state') != 'done')
+                        | Eval('imported', False)),
+                    'icon': 'tryton-launch',
+                    },
+                'donor_certificates': {
+                    'invisible': ~Eval('state').in_(['calculated', 'done']),
+                    'icon': 'tryton-print',
+                    },
+                'preview_wizard': {
+                    'invisible': (Eval('imported', False)
+                        | (Eval('state') == 'cancelled')),
+                    'icon': 'tryton-search',
+                    },
+                'export_lines': {
+                    'invisible': ~Eval('state').in_(['calculated', 'done']),
+                    'icon': 'tryton-save',
+                    },
+                'archive_file': {
+                    'invisible': ((Eval('state') != 'done')
+                        | ~Eval('file_id') | Bool(Eval('archive_id'))),
+                    'icon': 'tryton-archive',
+                    },
+                })
+        cls.__rpc__.update({
+                'preview': RPC(readonly=True, instantiate=0),
                 })
         cls._transitions |= set((
+                ('draft', 'calculating'),
                 ('draft', 'calculated'),
                 ('draft', 'cancelled'),
+                ('calculating', 'calculated'),
+                ('calculating', 'draft'),
+                ('calculating', 'cancelled'),
                 ('calculated', 'draft'),
+                ('calculated', 'generating'),
                 ('calculated', 'done'),
                 ('calculated', 'cancelled'),
+                ('generating', 'calculated'),
+                ('generating', 'done'),
+                ('generating', 'draft'),
+                ('generating', 'cancelled'),
                 ('done', 'cancelled'),
                 ('cancelled', 'draft'),
                 ))
 
+    @classmethod
+    def __register__(cls, module_name):
+        table_h = cls.__table_handler__(module_name)
+        migrate_file = (table_h.column_exist('file_')
+            and not table_h.column_exist('file_id'))
+
+        super(Report, cls).__register__(module_name)
+        table_h = cls.__table_handler__(module_name)
+
+        # Migration from the files stored in the database row
+        if migrate_file:
+            cls._migrate_file_to_filestore()
+
+        # Migration from 5.8: complementary and substitutive reports share
+        # the fiscal year, SQLite never created the constraint
+        if backend.name != 'sqlite':
+            table_h.drop_constraint('code_uniq')
+
+        # Index the lookups of reports by company and year
+        table_h.index_action(['company', 'fiscalyear_code'], 'add')
+
+    @classmethod
+    def _migrate_file_to_filestore(cls):
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        prefix = get_prefix(cls.file_)
+
+        cursor.execute(*table.select(table.id,
+                where=table.file_ != Null))
+        for report_id, in cursor.fetchall():
+            cursor.execute(*table.select(table.file_,
+                    where=table.id == report_id))
+            data, = cursor.fetchone()
+            cursor.execute(*table.update(
+                    [table.file_id, table.file_],
+                    [filestore.set(bytes(data), prefix), Null],
+                    where=table.id == report_id))
+
     @classmethod
     def validate(cls, reports):
         for report in reports:
@@ -270,11 +525,6 @@ class Report(Workflow, ModelSQL, ModelView):
         res = {r.id: r.currency.digits for r in records}
         return res
 
-    @classmethod
-    def get_total_sheets(cls, reports, name=None):
-        res = {r.id: len(r.report_parties) / 6 + 1 for r in reports}
-        return res
-
     @staticmethod
     def default_declarant_nature():
         return '2'
@@ -302,54 +552,161 @@ class Report(Workflow, ModelSQL, ModelView):
         return 2
 
     @staticmethod
-    def default_donation_amount_threshold():
-        return Decimal('150')
+    def default_imported():
+        return False
 
-    @staticmethod
-    def default_first_less_physical():
-        return Decimal('75')
+    def get_rec_name(self, name):
+        return '%s - %s' % (self.company.rec_name,
+            self.fiscalyear.name if self.fiscalyear else self.fiscalyear_code)
 
-    @staticmethod
-    def default_first_greater_physical():
-        return Decimal('30')
+    @classmethod
+    def _get_totals_columns(cls, report_party):
+        "Return the aggregate expression of each total over report_party"
+        ReportParty = Pool().get('aeat.182.report.party')
+        count = Count(report_party.id)
+        return {
+            'total_number_of_donor_records': count,
+            'amount_of_donations': ReportParty.amount.sql_cast(
+                Coalesce(Sum(report_party.amount), 0)),
+            'total_sheets': count / 6 + 1,
+            }
 
     @staticmethod
-    def default_pluriannual_physical():
-        return Decimal('35')
+    def _get_totals_defaults():
+        "Return the value of each total for a report without lines"
+        return {
+            'total_number_of_donor_records': 0,
+            'amount_of_donations': Decimal('0.0'),
+            'total_sheets': 1,
+            }
 
-    @staticmethod
-    def default_first_less_artificial():
-        return Decimal('35')
+    @classmethod
+    def _get_totals_query(cls):
+        "Return the query of the totals by report of the reports with lines"
+        ReportParty = Pool().get('aeat.182.report.party')
+        report_party = ReportParty.__table__()
+        columns = cls._get_totals_columns(report_party)
+        return report_party.select(report_party.report.as_('report'),
+            *[c.as_(n) for n, c in columns.items()],
+            group_by=report_party.report)
 
-    @staticmethod
-    def default_first_greater_artificial():
-        return Decimal('35')
+    @classmethod
+    def _get_totals_column(cls, totals, name):
+        """
+        Return the total name from the totals query joined with LEFT, with
+        the value of get_totals for the reports without lines
+        """
+        ReportParty = Pool().get('aeat.182.report.party')
+        default = cls._get_totals_defaults()[name]
+        if name == 'amount_of_donations':
+            # Need to cast numeric for sqlite
+            return ReportParty.amount.sql_cast(
+                Coalesce(Column(totals, name), Literal(default)))
+        return Coalesce(Column(totals, name), default)
 
-    @staticmethod
-    def default_pluriannual_artificial():
-        return Decimal('40')
+    @classmethod
+    def get_totals(cls, reports, names):
+        ReportParty = Pool().get('aeat.182.report.party')
+        cursor = Transaction().connection.cursor()
+        report_party = ReportParty.__table__()
 
-    def get_rec_name(self, name):
-        return '%s - %s' % (self.company.rec_name, self.fiscalyear.name)
+        defaults = cls._get_totals_defaults()
+        result = {n: {r.id: defaults[n] for r in reports} for n in names}
+
+        columns = cls._get_totals_columns(report_party)
+        for sub_reports in grouped_slice(reports):
+            sub_reports = {r.id: r for r in sub_reports}
+            cursor.execute(*report_party.select(report_party.report,
+                    *[columns[n] for n in names],
+                    where=reduce_ids(report_party.report, sub_reports.keys()),
+                    group_by=report_party.report))
+            for row in cursor.fetchall():
+                report = sub_reports[row[0]]
+                for name, value in zip(names, row[1:]):
+                    if name == 'amount_of_donations':
+                        # SQLite uses float for SUM
+                        if not isinstance(value, Decimal):
+                            value = Decimal(str(value))
+                        value = report.currency.round(value)
+                    result[name][report.id] = value
+        return result
 
     @classmethod
-    def get_totals(cls, reports, names):
+    def search_totals(cls, name, clause):
+        """
+        Search on the aggregates of the lines. Reports without lines match
+        the values shown by get_totals, None matches no report.
+        """
+        ReportParty = Pool().get('aeat.182.report.party')
+        table = cls.__table__()
+        totals = cls._get_totals_query()
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+
+        column = cls._get_totals_column(totals, name)
+
+        def convert(value):
+            if name == 'amount_of_donations':
+                # Need to cast numeric for sqlite
+                return ReportParty.amount.sql_cast(Literal(Decimal(value)))
+            return value
+
+        if operator in {'in', 'not in'}:
+            values = [convert(v) for v in value if v is not None]
+            if values:
+                where = Operator(column, values)
+            else:
+                where = Literal(operator == 'not in')
+        elif value is None:
+            where = Literal(operator == '!=')
+        else:
+            where = Operator(column, convert(value))
+        query = table.join(totals, 'LEFT',
+            condition=totals.report == table.id
+            ).select(table.id, where=where)
+        return [('id', 'in', query)]
+
+    order_total_number_of_donor_records = _order_totals(
+        'total_number_of_donor_records')
+    order_amount_of_donations = _order_totals('amount_of_donations')
+    order_total_sheets = _order_totals('total_sheets')
+
+    @classmethod
+    def get_progress(cls, reports, names):
+        Progress = Pool().get('aeat.182.report.progress')
         result = {n: {r.id: None for r in reports} for n in names}
-        for name in names:
-            for report in reports:
-                if name == 'total_number_of_donor_records':
-                    result[name][report.id] = len(report.report_parties)
-                elif name == 'amount_of_donations':
-                    result[name][report.id] = (report.currency.round(
-                        Decimal(sum([l.amount for l in report.report_parties])))
-                            if report.report_parties else Decimal('0.0'))
+        for sub_ids in grouped_slice([r.id for r in reports]):
+            for progress in Progress.search([
+                        ('report', 'in', list(sub_ids)),
+                        ]):
+                if 'processed_donors' in names:
+                    result['processed_donors'][progress.report.id] = (
+                        progress.processed)
+                if 'total_donors' in names:
+                    result['total_donors'][progress.report.id] = (
+                        progress.total)
         return result
 
     def get_currency(self, name):
         return self.company.currency.id
 
+    def get_deduction_rates(self, name):
+        DeductionRate = Pool().get('aeat.182.deduction.rate')
+        if self.fiscalyear_code:
+            return [r.id for r in DeductionRate.get_rates(
+                    self.fiscalyear_code, self.company)]
+        return []
+
     def get_filename(self, name):
-        return 'aeat182-%s.txt' % self.fiscalyear_code
+        if name == 'certificates_filename':
+            return 'aeat182-%s-certificates.zip' % self.fiscalyear_code
+        elif name == 'export_filename':
+            return 'aeat182-%s-lines.%s' % (
+                self.fiscalyear_code, self.export_format)
+        filename = 'aeat182-%s.txt' % self.fiscalyear_code
+        if name == 'archive_filename':
+            filename += '.gz'
+        return filename
 
     @fields.depends('fiscalyear')
     def on_change_with_fiscalyear_code(self):
@@ -370,240 +727,1521 @@ class Report(Workflow, ModelSQL, ModelView):
             self.company_phone = phone or ''
 
     def pluriannual_applicable(self, report_party):
-        ReportParty = Pool().get('aeat.182.report.party')
+        return report_party['party_vat'] in self.get_pluriannual_vats({
+                report_party['party_vat']: report_party['amount'],
+                })
 
-        previous_years = []
-        number_of_previous_years = self.periods_for_pluriannual_donation
-        year = self.fiscalyear_code
-        for _ in range(number_of_previous_years):
-            year -= 1
-            previous_years.append(year)
+    def get_previous_fiscalyear_codes(self):
+        return [self.fiscalyear_code - i
+            for i in range(1, self.periods_for_pluriannual_donation + 1)]
 
-        report_parties = ReportParty.search([
-                ('party_vat', '=', report_party['party_vat']),
-                ('report.fiscalyear_code', 'in', previous_years)
-                ])
-        applicable = (len({r.report for r in report_parties}) ==
-            number_of_previous_years)
-        if applicable:
-            amount = report_party['amount']
-            for r_party in sorted(report_parties,
-                    key=lambda x: x.report.fiscalyear_code,
-                    reverse=True):
-                applicable &= r_party.amount <= amount
-                amount = r_party.amount
-        return applicable
+    def get_pluriannual_vats(self, amounts, previous_years=None):
+        """
+        Return the set of party VATs, from the dictionary of amounts by VAT,
+        that have donated in each of the previous years an amount not greater
+        than the one of the following year.
+        The amounts of the previous years are read from the donor history
+        and, for the years without history, from their calculated reports.
+        """
+        pool = Pool()
+        DonorHistory = pool.get('aeat.182.donor.history')
+        cursor = Transaction().connection.cursor()
+        history_table = DonorHistory.__table__()
+
+        if previous_years is None:
+            previous_years = self.get_previous_fiscalyear_codes()
+        vats = {v for v in amounts if v}
+        if not previous_years:
+            return vats
+        if not vats:
+            return set()
+
+        history = defaultdict(dict)
+        with phase('pluriannual') as result:
+            cursor.execute(*history_table.select(
+                    history_table.fiscalyear_code,
+                    where=((history_table.company == self.company.id)
+                        & history_table.fiscalyear_code.in_(previous_years)),
+                    group_by=history_table.fiscalyear_code))
+            calculated_years = list(
+                set(previous_years) - {y for y, in cursor.fetchall()})
+            for sub_vats in grouped_slice(vats):
+                queries = self.get_pluriannual_queries(
+                    list(sub_vats), previous_years, calculated_years)
+                for query in queries:
+                    cursor.execute(*query)
+                    for vat, year, amount in cursor.fetchall():
+                        # SQLite uses float for SUM
+                        if not isinstance(amount, Decimal):
+                            amount = Decimal(str(amount))
+                        history[vat][year] = amount
+            result['rows'] = len(vats)
+
+        pluriannual = set()
+        years = sorted(previous_years, reverse=True)
+        for vat, amount_by_year in history.items():
+            if len(amount_by_year) != len(years):
+                continue
+            amount = amounts[vat]
+            for year in years:
+                if amount_by_year[year] > amount:
+                    break
+                amount = amount_by_year[year]
+            else:
+                pluriannual.add(vat)
+        return pluriannual
+
+    def get_pluriannual_queries(self, vats, previous_years,
+            calculated_years):
+        """
+        Return the queries of the amounts by VAT and year of vats read by
+        get_pluriannual_vats: the donor history of previous_years and the
+        calculated reports of calculated_years.
+        """
+        pool = Pool()
+        DonorHistory = pool.get('aeat.182.donor.history')
+        ReportParty = pool.get('aeat.182.report.party')
+        history = DonorHistory.__table__()
+        report = self.__table__()
+        report_party = ReportParty.__table__()
+
+        queries = [history.select(
+                history.party_vat, history.fiscalyear_code, history.amount,
+                where=((history.company == self.company.id)
+                    & history.fiscalyear_code.in_(previous_years)
+                    & history.party_vat.in_(vats)))]
+        if calculated_years:
+            queries.append(report_party.join(report,
+                    condition=report_party.report == report.id
+                    ).select(
+                    report_party.party_vat, report.fiscalyear_code,
+                    Sum(report_party.amount),
+                    where=((report.company == self.company.id)
+                        & report.fiscalyear_code.in_(calculated_years)
+                        & (report.state == 'calculated')
+                        & report_party.party_vat.in_(vats)),
+                    group_by=(report_party.party_vat,
+                        report.fiscalyear_code)))
+        return queries
 
     @property
     def map_subdivision_code(self):
+        return self.get_subdivision_codes()
+
+    @classmethod
+    def get_subdivision_codes(cls):
+        """
+        Return the province code by (country id, subdivision id) computed
+        from the zips of each subdivision.
+        Subdivisions without zips fall back to the province of their ISO
+        3166-2 code or, for Spanish subdivisions, to the numeric part of their
+        code.
+        """
         pool = Pool()
+        Country = pool.get('country.country')
         Zip = pool.get('country.zip')
-        zips = Zip.search([])
-        return {(z.country.id, z.subdivision.id): z.zip[:2] for z in zips}
+        Subdivision = pool.get('country.subdivision')
+
+        codes = cls._subdivision_code_cache.get(None)
+        if codes is None:
+            cursor = Transaction().connection.cursor()
+            subdivision = Subdivision.__table__()
+            country = Country.__table__()
+            zip_ = Zip.__table__()
+            cursor.execute(*subdivision.join(country,
+                    condition=country.id == subdivision.country
+                    ).join(zip_, 'LEFT',
+                    condition=(zip_.subdivision == subdivision.id)
+                    ).select(
+                    subdivision.country, subdivision.id, subdivision.code,
+                    country.code, Min(zip_.zip),
+                    group_by=(subdivision.country, subdivision.id,
+                        subdivision.code, country.code)))
+            codes = []
+            for country_id, subdivision_id, code, country_code, zip_code in (
+                    cursor.fetchall()):
+                if zip_code:
+                    code = zip_code[:2]
+                elif code in ISO_PROVINCE_CODES:
+                    code = ISO_PROVINCE_CODES[code]
+                elif country_code == 'ES':
+                    code = (code or '').split('-')[-1]
+                    if not code.isdigit():
+                        continue
+                    code = code.zfill(2)
+                else:
+                    continue
+                codes.append((country_id, subdivision_id, code))
+            cls._subdivision_code_cache.set(None, codes)
+        return {(c, s): code for c, s, code in codes}
+
+    @classmethod
+    def get_parties_data(cls, party_ids):
+        """
+        Return a dictionary by party id with the tax identifier code, name,
+        party type and the country and subdivision ids of the default address
+        of each party.
 
-    def get_report_parties(self, fiscalyear):
+        Values are read in batches so the number of queries does not depend
+        on the number of parties.
+        """
         pool = Pool()
-        MoveLine = pool.get('account.move.line')
         Party = pool.get('party.party')
-        Account = pool.get('account.account')
+        Identifier = pool.get('party.identifier')
+        Address = pool.get('party.address')
+
+        tax_identifier_types = Party.tax_identifier_types()
+        result = {}
+        for sub_ids in grouped_slice(party_ids):
+            sub_ids = list(sub_ids)
+            for party in Party.read(sub_ids, ['name', 'party_type']):
+                result[party['id']] = {
+                    'vat': None,
+                    'name': party['name'],
+                    'party_type': party['party_type'],
+                    'country': None,
+                    'subdivision': None,
+                    }
+            # Records are returned in the same order than the One2Many fields
+            # so the first one found for each party is the one to use
+            found = set()
+            for identifier in Identifier.search_read([
+                        ('party', 'in', sub_ids),
+                        ('type', 'in', tax_identifier_types),
+                        ], fields_names=['party', 'code']):
+                if identifier['party'] in found:
+                    continue
+                found.add(identifier['party'])
+                result[identifier['party']]['vat'] = identifier['code']
+            found = set()
+            for address in Address.search_read([
+                        ('party', 'in', sub_ids),
+                        ], fields_names=['party', 'country', 'subdivision']):
+                if address['party'] in found:
+                    continue
+                found.add(address['party'])
+                result[address['party']].update({
+                        'country': address['country'],
+                        'subdivision': address['subdivision'],
+                        })
+        return result
+
+    def _get_donation_lines_where(self, line, move, fiscalyear):
+        "Return the condition of the donation lines of the fiscal year"
+        return (line.account.in_([a.id for a in self.accounts])
+            & move.period.in_([p.id for p in fiscalyear.periods])
+            & (line.party != Null))
+
+    def get_report_parties_query(self, fiscalyear, parties=None):
+        """
+        Return the query of the amount and the number of donation lines by
+        party
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
         Move = pool.get('account.move')
-        Period = pool.get('account.period')
-        cursor = Transaction().connection.cursor()
 
         line = MoveLine.__table__()
-        party = Party.__table__()
-        account = Account.__table__()
         move = Move.__table__()
-        period = Period.__table__()
-        map_party_type = {
-            'organization': 'J',
-            'person': 'F',
-            }
-        query = (line
-            .join(account, 'LEFT', condition=(line.account == account.id))
-            .join(move, 'LEFT', condition=(line.move == move.id))
-            .join(period, 'LEFT', condition=(move.period == period.id))
+        where = self._get_donation_lines_where(line, move, fiscalyear)
+        if parties is not None:
+            where &= reduce_ids(line.party, [int(p) for p in parties])
+        return (line
+            .join(move, condition=(line.move == move.id))
             .select(
                 line.party,
                 (Sum(line.credit) - Sum(line.debit)),
-                where=(
-                        (period.fiscalyear == fiscalyear.id)
-                    &
-                        (account.id.in_(
-                                [a.id for a in self.accounts]))
-                    &
-                        (line.party != Null)
-                    ),
-                group_by=(
-                    account.code,
-                    line.party,
-                    ),
+                Count(line.id),
+                where=where,
+                group_by=line.party,
                 )
             )
+
+    def get_report_parties(self, fiscalyear, parties=None):
+        cursor = Transaction().connection.cursor()
+        map_party_type = {
+            'organization': 'J',
+            'person': 'F',
+            }
+        query = self.get_report_parties_query(fiscalyear, parties=parties)
         cursor.execute(*query)
+        records = cursor.fetchall()
+        with phase('get_parties_data') as result:
+            parties = self.get_parties_data([r[0] for r in records])
+            result['rows'] = len(parties)
+        currency = self.currency
+        map_subdivision_code = None
         report_parties = []
         report_id = self.id
-        company_id = self.company.id
-        for record in cursor.fetchall():
-            party = Party(record[0])
-            address = party.address_get()
+        for party_id, amount, donation_lines in records:
+            party = parties[party_id]
             subdivision_code = '00'
-            amount = record[1]
             # SQLite uses float for SUM
             if not isinstance(amount, Decimal):
                 amount = Decimal(str(amount))
-            amount = self.currency.round(amount)
-            if address:
-                country = address.country or None
-                subdivision = address.subdivision or None
-                if subdivision and country:
-                    subdivision_code = self.map_subdivision_code[
-                        (country.id, subdivision.id)]
+            amount = currency.round(amount)
+            if party['country'] and party['subdivision']:
+                if map_subdivision_code is None:
+                    map_subdivision_code = self.map_subdivision_code
+                subdivision_code = map_subdivision_code.get(
+                    (party['country'], party['subdivision']), '00')
             report_party = {
-                'party': party.id,
-                'party_vat': (party.tax_identifier and
-                    party.tax_identifier.code[-9:] or ''),
-                'party_name': party.name,
-                'nature': map_party_type.get(party.party_type),
+                'party': party_id,
+                'party_vat': party['vat'] and party['vat'][-9:] or '',
+                'party_name': party['name'],
+                'nature': map_party_type.get(party['party_type']),
                 'party_subdivision_code': subdivision_code,
                 'amount': amount,
+                'donation_lines': donation_lines,
                 'key': 'A',
                 'report': report_id,
                 }
             report_parties.append(report_party)
         return report_parties
 
+    @classmethod
+    @ModelView.button_action('aeat_182.wizard_report_preview')
+    def preview_wizard(cls, reports):
+        pass
+
+    @classmethod
+    def preview(cls, reports, limit=10):
+        '''
+        Return by report id the figures of the calculation of reports
+        without storing their lines: the number of donors and the amount in
+        total, by nature, by deduction band and by province, and the limit
+        donors of greater amount.
+        It is run in a read-only transaction.
+        '''
+        transaction = Transaction()
+        if not transaction.readonly:
+            with transaction.new_transaction(readonly=True):
+                return cls.preview(
+                    cls.browse([r.id for r in reports]), limit=limit)
+
+        def group(report_parties, *keys):
+            groups = defaultdict(lambda: [0, Decimal(0)])
+            for report_party in report_parties:
+                counter = groups[tuple(report_party[k] for k in keys)]
+                counter[0] += 1
+                counter[1] += report_party['amount']
+            return [dict(zip(keys, key), donors=donors, amount=amount)
+                for key, (donors, amount) in sorted(groups.items(),
+                    key=lambda g: tuple(str(k) for k in g[0]))]
+
+        result = {}
+        for report in reports:
+            report_parties = []
+            if report.accounts and report.fiscalyear:
+                report_parties = report.get_report_parties(report.fiscalyear)
+                report.set_percentage_deductions(report_parties)
+            result[report.id] = {
+                'donors': len(report_parties),
+                'amount': sum((p['amount'] for p in report_parties),
+                    Decimal(0)),
+                'natures': group(report_parties, 'nature'),
+                'bands': group(
+                    report_parties, 'nature', 'percentage_deduction'),
+                'provinces': group(report_parties, 'party_subdivision_code'),
+                'first_donors': [{
+                        k: p[k] for k in ['party_vat', 'party_name',
+                            'nature', 'party_subdivision_code', 'amount',
+                            'percentage_deduction']}
+                    for p in heapq.nlargest(limit, report_parties,
+                        key=lambda p: p['amount'])],
+                }
+        return result
+
+    def get_changed_parties(self, fiscalyear, since):
+        """
+        Return the ids of parties with donation lines changed after since,
+        the watermark of the last calculation, and of the parties of the
+        report whose number of donation lines is not the one of its
+        calculation, as it happens when a donation line is deleted or moved
+        to another party, account or fiscal year.
+        Without since every party with donation lines is returned.
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        ReportParty = pool.get('aeat.182.report.party')
+        cursor = Transaction().connection.cursor()
+
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        report_party = ReportParty.__table__()
+        where = self._get_donation_lines_where(line, move, fiscalyear)
+        changed = where
+        if since is not None:
+            # The lines of the watermark were read by the last calculation
+            changed &= Coalesce(line.write_date, line.create_date) > since
+        cursor.execute(*line
+            .join(move, condition=line.move == move.id)
+            .select(line.party, where=changed, group_by=line.party))
+        parties = {p for p, in cursor.fetchall()}
+
+        current = (line
+            .join(move, condition=line.move == move.id)
+            .select(line.party.as_('party'),
+                Count(line.id).as_('donation_lines'),
+                where=where,
+                group_by=line.party))
+        calculated = report_party.select(
+            report_party.party.as_('party'),
+            Coalesce(Sum(report_party.donation_lines), 0).as_(
+                'donation_lines'),
+            where=(report_party.report == self.id)
+            & (report_party.party != Null),
+            group_by=report_party.party)
+        cursor.execute(*calculated
+            .join(current, 'LEFT',
+                condition=calculated.party == current.party)
+            .select(calculated.party,
+                where=(Coalesce(current.donation_lines, 0)
+                    != calculated.donation_lines)))
+        parties.update(p for p, in cursor.fetchall())
+        return list(parties)
+
+    def get_donation_watermark(self, fiscalyear):
+        """
+        Return the last write or create date of the donation lines from the
+        database to detect the lines changed after a calculation
+        """
+        pool = Pool()
+        MoveLine = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        cursor = Transaction().connection.cursor()
+
+        line = MoveLine.__table__()
+        move = Move.__table__()
+        cursor.execute(*line
+            .join(move, condition=line.move == move.id)
+            .select(Max(Coalesce(line.write_date, line.create_date)),
+                where=self._get_donation_lines_where(line, move, fiscalyear)))
+        watermark, = cursor.fetchone()
+        # SQLite returns the aggregated timestamp as a string
+        if isinstance(watermark, str):
+            watermark = datetime.datetime.fromisoformat(watermark)
+        return watermark
+
+    def set_percentage_deductions(self, report_parties):
+        """
+        Set the percentage_deduction of each report_parties values from the
+        deduction rates of the fiscal year.
+        """
+        DeductionRate = Pool().get('aeat.182.deduction.rate')
+        amounts = defaultdict(Decimal)
+        for report_party in report_parties:
+            amounts[report_party['party_vat']] += report_party['amount']
+        pluriannual_vats = self.get_pluriannual_vats(amounts)
+
+        rates = DeductionRate.get_table(self.fiscalyear_code, self.company)
+        percentages = DeductionRate.classify(rates, (
+                (p['nature'], p['amount'], p['party_vat'] in pluriannual_vats)
+                for p in report_parties))
+        for report_party, percentage in zip(report_parties, percentages):
+            report_party['percentage_deduction'] = percentage
+
     @classmethod
     @ModelView.button
     @Workflow.transition('draft')
     def draft(cls, reports):
+        DonorHistory = Pool().get('aeat.182.donor.history')
+        DonorHistory.clear_reports(reports)
         cls._delete_lines(reports)
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('calculated')
     def calculate(cls, reports):
-        pool = Pool()
-        ReportParty = pool.get('aeat.182.report.party')
-        Date = pool.get('ir.date')
+        if cls.use_queue():
+            reports = cls.wait_calculate(reports)
+            with Transaction().set_context(queue_name='aeat_182'):
+                cls.__queue__.run_task(reports, 'do_calculate')
+        else:
+            cls.do_calculate(reports)
+
+    @classmethod
+    def calculate_all(cls, reports):
+        '''
+        Calculate each draft report in its own transaction with the context
+        of its company, an error only rolls back its report.
+        The reports are calculated one after the other, their parallel
+        calculation is left to the workers of the queue: when it is enabled
+        each report is pushed as its own task, the seconds and the error only
+        cover the push and the result of the task is given by
+        calculate_all_status.
+        Return a list of (report id, seconds, error message).
+        '''
+        transaction = Transaction()
+        results = []
+        for report in reports:
+            if report.state != 'draft':
+                continue
+            error = None
+            start = time.perf_counter()
+            try:
+                with transaction.set_context(company=report.company.id), \
+                        transaction.new_transaction():
+                    cls.calculate([cls(report.id)])
+            except Exception as exception:
+                logger.exception('Fail to calculate report %s', report.id)
+                error = getattr(exception, 'message', None) or str(exception)
+            results.append((report.id, time.perf_counter() - start, error))
+        return results
+
+    @classmethod
+    def calculate_all_status(cls, reports):
+        '''
+        Return a list of (report id, state, error message) of reports with
+        the error of the last failed task of the reports back to draft.
+        '''
+        Error = Pool().get('aeat.182.report.error')
+        errors = {}
+        drafts = [r.id for r in reports if r.state == 'draft']
+        for sub_ids in grouped_slice(drafts):
+            for error in Error.search([
+                        ('report', 'in', list(sub_ids)),
+                        ('line', '=', None),
+                        ], order=[('id', 'ASC')]):
+                errors[error.report.id] = error.message
+        return [(r.id, r.state, errors.get(r.id)) for r in reports]
+
+    @classmethod
+    @Workflow.transition('calculating')
+    def wait_calculate(cls, reports):
+        cls._reset_progress(reports)
+        return reports
+
+    @classmethod
+    @Workflow.transition('calculated')
+    def do_calculate(cls, reports):
+        cls._calculate(reports)
+
+    @classmethod
+    def _calculate(cls, reports):
+        Date = Pool().get('ir.date')
 
         cls._delete_lines(reports)
         today = Date.today()
 
-        vlist = []
+        created = False
         for report in reports:
             if not report.accounts or not report.fiscalyear:
                 continue
             report.date = today
+            report.last_calculation = report.get_donation_watermark(
+                report.fiscalyear)
+            with instrument('calculate') as stats:
+                with phase('get_report_parties') as result:
+                    report_parties = report.get_report_parties(
+                        report.fiscalyear)
+                    result['rows'] = len(report_parties)
+                with phase('set_percentage_deductions') as result:
+                    report.set_percentage_deductions(report_parties)
+                    result['rows'] = len(report_parties)
+                report.set_progress(0, len(report_parties))
 
-            report_parties = report.get_report_parties(report.fiscalyear)
-
-            for report_party in report_parties:
-                percentage_deduction = None
-                if report_party['nature'] == 'F':  # [F]. Physical person
-                    if (report_party['amount']
-                            <= report.donation_amount_threshold):
-                        percentage_deduction = report.first_less_physical
-                    elif report.pluriannual_applicable(report_party):
-                        percentage_deduction = (
-                            report.pluriannual_physical)
-                    else:
-                        percentage_deduction = report.first_greater_physical
-
-                elif report_party['nature'] == 'J':  # [J]. Artificial person
-                    if report.pluriannual_applicable(report_party):
-                        percentage_deduction = (
-                            report.pluriannual_artificial)
-                    elif (report_party['amount']
-                            <= report.donation_amount_threshold):
-                        percentage_deduction = report.first_less_artificial
-                    else:
-                        percentage_deduction = report.first_greater_artificial
-                report_party['percentage_deduction'] = percentage_deduction
-                vlist.append(report_party)
+                processed = 0
+                for vlist in grouped_slice(report_parties):
+                    vlist = list(vlist)
+                    with phase('create_lines') as result:
+                        cls._create_lines(vlist)
+                        result['rows'] = len(vlist)
+                    processed += len(vlist)
+                    created = True
+                    report.set_progress(processed)
+            if stats is not None:
+                report.stats = stats.summary()
 
-        if vlist:
-            ReportParty.create(vlist)
+        if created:
             cls.save(reports)
 
+    @classmethod
+    @ModelView.button
+    def recalculate(cls, reports):
+        '''
+        Update only the lines of the parties with donation lines created,
+        modified, moved or deleted since the last calculation keeping the
+        manual changes.
+        '''
+        Date = Pool().get('ir.date')
+
+        today = Date.today()
+        reports = [r for r in reports if r.state == 'calculated']
+        to_calculate, to_save = [], []
+        for report in reports:
+            if not report.accounts or not report.fiscalyear:
+                continue
+            if not report.last_calculation:
+                to_calculate.append(report)
+                continue
+            with instrument('recalculate') as stats:
+                report._recalculate()
+            report.date = today
+            if stats is not None:
+                report.stats = stats.summary()
+            to_save.append(report)
+        cls.save(to_save)
+        if to_calculate:
+            cls._calculate(to_calculate)
+
+    def _recalculate(self):
+        "Update the lines of the parties changed since the last calculation"
+        ReportParty = Pool().get('aeat.182.report.party')
+
+        watermark = self.get_donation_watermark(self.fiscalyear)
+        party_ids = self.get_changed_parties(
+            self.fiscalyear, self.last_calculation)
+        self.last_calculation = watermark
+        if not party_ids:
+            return
+
+        new_lines = defaultdict(list)
+        with phase('get_report_parties') as result:
+            report_parties = self.get_report_parties(
+                self.fiscalyear, parties=party_ids)
+            result['rows'] = len(report_parties)
+        with phase('set_percentage_deductions') as result:
+            self.set_percentage_deductions(report_parties)
+            result['rows'] = len(report_parties)
+        for report_party in report_parties:
+            new_lines[report_party['party']].append(report_party)
+        lines = defaultdict(list)
+        for sub_ids in grouped_slice(party_ids):
+            for line in ReportParty.search([
+                        ('report', '=', self.id),
+                        ('party', 'in', list(sub_ids)),
+                        ], order=[('id', 'ASC')]):
+                lines[line.party.id].append(line)
+
+        to_create, to_write, to_delete = [], [], []
+        for party_id in party_ids:
+            values = new_lines[party_id]
+            for line, line_values in zip(lines[party_id], values):
+                to_write.extend(([line], {
+                            f: line_values[f]
+                            for f in ReportParty._calculated_fields()
+                            }))
+            to_create.extend(values[len(lines[party_id]):])
+            to_delete.extend(lines[party_id][len(values):])
+
+        if to_delete:
+            ReportParty.delete(to_delete)
+        if to_write:
+            ReportParty.write(*to_write)
+        if to_create:
+            self._create_lines(to_create)
+
+    @classmethod
+    def _create_lines(cls, vlist):
+        """
+        Insert the report party lines of vlist, values computed by the
+        calculation, by batches with SQL instead of the ORM.
+        The access rights and the create rules of the lines are checked as
+        the ORM does and the errors of check_values are stored like
+        check_lines does.
+        """
+        pool = Pool()
+        Line = pool.get('aeat.182.report.party')
+        ModelAccess = pool.get('ir.model.access')
+        ModelFieldAccess = pool.get('ir.model.field.access')
+        transaction = Transaction()
+        database = transaction.database
+        cursor = transaction.connection.cursor()
+        table = Line.__table__()
+
+        for values in vlist:
+            for field_name in ['report', 'key', 'amount']:
+                if values.get(field_name) is None:
+                    raise UserError(gettext('aeat_182.msg_line_required',
+                            field=Line._fields[field_name].string,
+                            party=values.get('party_name') or ''))
+        names = sorted({n for v in vlist for n in v})
+        ModelAccess.check(Line.__name__, 'create')
+        ModelFieldAccess.check(Line.__name__, names, 'write')
+
+        checked_names = Line._checked_fields()
+        columns = [table.create_uid, table.create_date] + [
+            Column(table, n) for n in names]
+        count = max(1, database.IN_MAX // len(columns))
+        for sub_vlist in grouped_slice(vlist, count):
+            sub_vlist = list(sub_vlist)
+            returning = [table.id] if database.has_returning() else None
+            cursor.execute(*table.insert(columns, [
+                        [transaction.user, CurrentTimestamp()] + [
+                            Line._fields[n].sql_format(v.get(n))
+                            for n in names]
+                        for v in sub_vlist], returning=returning))
+            if returning:
+                ids = [i for i, in cursor.fetchall()]
+            else:
+                # SQLite gives consecutive ids to the rows of an insert
+                last_id = cursor.lastrowid
+                ids = list(range(last_id - len(sub_vlist) + 1, last_id + 1))
+            cls._check_lines_rule(lambda t: reduce_ids(t.id, ids), 'create')
+            cls._insert_check_errors(
+                (v['report'], i, {n: v.get(n) for n in checked_names})
+                for v, i in zip(sub_vlist, ids))
+
+    @classmethod
+    def _check_lines_rule(cls, where, mode):
+        """
+        Raise AccessError if a line matching where, a function returning the
+        condition on the table of the lines, fails the rules of mode, create
+        or delete.
+        """
+        pool = Pool()
+        Line = pool.get('aeat.182.report.party')
+        Rule = pool.get('ir.rule')
+        cursor = Transaction().connection.cursor()
+        table = Line.__table__()
+
+        domain = Rule.domain_get(Line.__name__, mode=mode)
+        if not domain:
+            return
+        tables, expression = Line.search_domain(domain, active_test=False,
+            tables={None: (table, None)})
+        cursor.execute(*convert_from(None, tables).select(
+                Count(table.id), Sum(Case((expression, 1), else_=0)),
+                where=where(table)))
+        total, allowed = cursor.fetchone()
+        if total and allowed != total:
+            raise AccessError(gettext('aeat_182.msg_line_%s_rule' % mode))
+
     @classmethod
     def _delete_lines(cls, reports):
+        """
+        Delete the lines and the errors of reports with SQL instead of the
+        ORM.
+        The access rights and the delete rules of the lines are checked as
+        the ORM does.
+        """
         pool = Pool()
         Line = pool.get('aeat.182.report.party')
-        Line.delete(Line.search([
-                    ('report', 'in', [r.id for r in reports]),
-                    ]))
+        Error = pool.get('aeat.182.report.error')
+        ModelAccess = pool.get('ir.model.access')
+        cursor = Transaction().connection.cursor()
+        table = Line.__table__()
+        error = Error.__table__()
+
+        ModelAccess.check(Line.__name__, 'delete')
+        for sub_ids in grouped_slice([r.id for r in reports]):
+            sub_ids = list(sub_ids)
+            cls._check_lines_rule(
+                lambda t: reduce_ids(t.report, sub_ids), 'delete')
+            cursor.execute(*error.delete(
+                    where=reduce_ids(error.report, sub_ids)))
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.report, sub_ids)))
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('done')
     def process(cls, reports):
+        if cls.use_queue():
+            reports = cls.wait_process(reports)
+            with Transaction().set_context(queue_name='aeat_182'):
+                cls.__queue__.run_task(reports, 'do_process')
+        else:
+            cls.do_process(reports)
+
+    @classmethod
+    @Workflow.transition('generating')
+    def wait_process(cls, reports):
+        cls._reset_progress(reports)
+        return reports
+
+    @classmethod
+    @Workflow.transition('done')
+    def do_process(cls, reports):
+        DonorHistory = Pool().get('aeat.182.donor.history')
         for report in reports:
             report.create_file()
+        DonorHistory.update_reports(reports)
 
     @classmethod
     @ModelView.button
-    @Workflow.transition('cancelled')
-    def cancel(cls, reports):
-        pass
+    def update_donor_history(cls, reports):
+        "Store the declared amounts of reports of prior years in the history"
+        DonorHistory = Pool().get('aeat.182.donor.history')
+        DonorHistory.update_reports([r for r in reports if r.state == 'done'])
 
-    def create_file(self):
-        fields = ('fiscalyear_code', 'company_vat', 'company_name', 'type',
-            'support_type', 'company_phone', 'contact_name', 'nature',
-            'declaration_number', 'protected_heritage_name',
-            'previous_number', 'total_number_of_donor_records',
-            'amount_of_donations', 'protected_heritage_vat')
+    @staticmethod
+    def use_queue():
+        "Return if calculate and process must be run by the task queue"
+        return config.getboolean('aeat_182', 'queue', default=False)
 
-        records = []
-        record = Record(aeat182.PRESENTER_RECORD)
-        for field in fields:
-            value = getattr(self, field, None)
-            if field == 'type':
-                if value != 'N':
-                    for v in DONATION_TYPE:
-                        if value == v[0]:
-                            setattr(record, v[1].lower(), value)
-                            break
-                continue
-            if isinstance(value, (int, float, Decimal)):
-                value = str(value)
-            if value is not None:
-                setattr(record, field, value)
-        records.append(record)
-        for report_party in self.report_parties:
-            record = report_party.get_record()
-            record.fiscalyear_code = str(self.fiscalyear_code)
-            record.company_vat = self.company_vat
-            records.append(record)
-        data = retrofix_write(records)
-        data = remove_accents(data).upper()
-        if isinstance(data, str):
-            data = data.encode('iso-8859-1')
-        self.file_ = self.__class__.file_.cast(data)
-        self.save()
+    @classmethod
+    def run_task(cls, reports, method, *args):
+        '''
+        Run method on the reports as a task of the queue.
+        If it fails, its changes are rolled back, the reports return to the
+        state before the task and the error is stored in their errors
+        instead of leaving them calculating or generating.
+        '''
+        transaction = Transaction()
+        try:
+            getattr(cls, method)(reports, *args)
+        except backend.DatabaseOperationalError:
+            # Let the worker retry the task
+            raise
+        except Exception as exception:
+            logger.exception('Fail to run %s on reports %s', method,
+                [r.id for r in reports])
+            transaction.rollback()
+            cls.fail_task(cls.browse([r.id for r in reports]),
+                getattr(exception, 'message', None) or str(exception))
 
+    @classmethod
+    def fail_task(cls, reports, message):
+        "Reset the reports of a failed task and store its error message"
+        Error = Pool().get('aeat.182.report.error')
+        cls.draft([r for r in reports if r.state == 'calculating'])
+        cls.unprocess([r for r in reports if r.state == 'generating'])
+        Error.create([{
+                    'report': r.id,
+                    'message': message,
+                    } for r in reports])
 
-class ReportAccount(ModelSQL):
-    'AEAT 182 Report Account'
-    __name__ = 'aeat.182.report.account'
-    report = fields.Many2One('aeat.182.report', 'Report', required=True,
-        ondelete='CASCADE')
-    account = fields.Many2One('account.account', 'Account', required=True,
-        ondelete='CASCADE')
+    @classmethod
+    @Workflow.transition('calculated')
+    def unprocess(cls, reports):
+        "Return the reports whose file generation failed to calculated"
+        pass
 
+    @classmethod
+    def _reset_progress(cls, reports):
+        Progress = Pool().get('aeat.182.report.progress')
+        Progress.delete(Progress.search([
+                    ('report', 'in', [r.id for r in reports]),
+                    ]))
+        Progress.create([{'report': r.id} for r in reports])
 
-class ReportParty(ModelSQL, ModelView):
-    'AEAT 182 Report Party'
-    __name__ = 'aeat.182.report.party'
+    def set_progress(self, processed, total=None):
+        """
+        Store the progress of the task running on the report.
+        It is committed in its own transaction to be visible while the task
+        is running, so it is only stored when the task starts, when it ends
+        and then at most once every progress_interval seconds.
+        """
+        Progress = Pool().get('aeat.182.report.progress')
+        if self.state not in {'calculating', 'generating'}:
+            return
+        now = time.monotonic()
+        # Records have slots so the total and the time of the last write are
+        # kept by report id
+        if total is not None:
+            self._progress_marks[self.id] = (total, now)
+        else:
+            last_total, last_time = self._progress_marks.get(
+                self.id, (None, now))
+            if processed == last_total:
+                self._progress_marks.pop(self.id, None)
+            elif now - last_time < config.getint(
+                    'aeat_182', 'progress_interval', default=1):
+                return
+            else:
+                self._progress_marks[self.id] = (last_total, now)
+        values = {'processed': processed}
+        if total is not None:
+            values['total'] = total
+        with Transaction().new_transaction():
+            progresses = Progress.search([
+                    ('report', '=', self.id),
+                    ])
+            if progresses:
+                Progress.write(progresses, values)
+            else:
+                values['report'] = self.id
+                Progress.create([values])
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('cancelled')
+    def cancel(cls, reports):
+        DonorHistory = Pool().get('aeat.182.donor.history')
+        DonorHistory.clear_reports(reports)
+
+    @classmethod
+    def import_file(cls, file_, company):
+        '''
+        Create a done report for company from file_, a binary file object
+        with the content of an AEAT 182 file, and store its amounts in the
+        donor history.
+        The file is read record by record and the lines are inserted by
+        batches so the memory used does not depend on its size.
+        Return the report and the list of (line number, error message) of
+        the records not imported.
+        '''
+        pool = Pool()
+        ReportParty = pool.get('aeat.182.report.party')
+        DonorHistory = pool.get('aeat.182.donor.history')
+
+        lines = ((n, l.decode('iso-8859-1').rstrip('\r\n'))
+            for n, l in enumerate(file_, 1))
+        lines = ((n, l) for n, l in lines if l.strip())
+        try:
+            _, line = next(lines)
+            values = cls._import_presenter_values(
+                Record.extract(line, aeat182.PRESENTER_RECORD))
+        except (StopIteration, AssertionError, RetrofixException,
+                ValueError) as exception:
+            raise UserError(gettext('aeat_182.msg_import_invalid_presenter',
+                    error=exception))
+        # Like the normal_uniq constraint, only one normal declaration is
+        # allowed by year and the complementary and substitutive ones are not
+        # limited
+        if values['type'] == 'N' and cls.search([
+                    ('company', '=', company.id),
+                    ('fiscalyear_code', '=', values['fiscalyear_code']),
+                    ('type', '=', 'N'),
+                    ('state', '!=', 'cancelled'),
+                    ], limit=1):
+            raise UserError(gettext('aeat_182.msg_import_report_exists',
+                    year=values['fiscalyear_code']))
+        expected_number = values.pop('total_number_of_donor_records')
+        expected_amount = values.pop('amount_of_donations')
+        values.update({
+                'company': company.id,
+                'imported': True,
+                'state': 'done',
+                })
+        report, = cls.create([values])
+
+        errors = []
+        number, amount = 0, Decimal(0)
+        vlist = []
+        size = max(1, Transaction().database.IN_MAX // 2)
+        for line_number, line in lines:
+            try:
+                line_values = ReportParty.values_from_record(
+                    Record.extract(line, aeat182.PARTY_RECORD))
+            except (AssertionError, RetrofixException,
+                    ValueError) as exception:
+                errors.append((line_number, str(exception)))
+                continue
+            line_values['report'] = report.id
+            vlist.append(line_values)
+            number += 1
+            amount += line_values['amount']
+            if len(vlist) >= size:
+                cls._import_lines(vlist)
+                vlist = []
+        if vlist:
+            cls._import_lines(vlist)
+
+        if (number, amount) != (expected_number, expected_amount):
+            errors.append((1, gettext('aeat_182.msg_import_totals',
+                        number=number, amount=amount,
+                        expected_number=expected_number,
+                        expected_amount=expected_amount)))
+        DonorHistory.update_reports([report])
+        return report, errors
+
+    @classmethod
+    def _import_presenter_values(cls, record):
+        "Return the values of a report from a retrofix PRESENTER_RECORD"
+        type_ = 'N'
+        if record.complementary.strip():
+            type_ = 'C'
+        elif record.substitutive.strip():
+            type_ = 'S'
+        return {
+            'fiscalyear_code': int(record.fiscalyear_code),
+            'company_vat': record.company_vat.strip(),
+            'company_name': record.company_name.strip(),
+            'company_phone': record.company_phone.lstrip('0') or None,
+            'contact_name': record.contact_name.strip(),
+            'type': type_,
+            'declaration_number': record.declaration_number.lstrip('0')
+            or None,
+            'previous_number': record.previous_number.lstrip('0') or None,
+            'declarant_nature': record.declarant_nature,
+            'protected_heritage_vat': record.protected_heritage_vat.strip()
+            or None,
+            'protected_heritage_name': record.protected_heritage_name.strip()
+            or None,
+            'presentation': cls.default_presentation(),
+            'total_number_of_donor_records': int(
+                record.total_number_of_donor_records),
+            'amount_of_donations': record.amount_of_donations,
+            }
+
+    @classmethod
+    def _import_lines(cls, vlist):
+        "Set the party from the VAT of the lines of vlist and insert them"
+        Identifier = Pool().get('party.identifier')
+
+        vats = {v['party_vat'] for v in vlist}
+        parties = {}
+        for identifier in Identifier.search_read([
+                    ('code', 'in', list(vats) + ['ES' + v for v in vats]),
+                    ], fields_names=['party', 'code']):
+            parties.setdefault(identifier['code'][-9:], identifier['party'])
+        for values in vlist:
+            values['party'] = parties.get(values['party_vat'])
+        cls._create_lines(vlist)
+
+    @classmethod
+    @ModelView.button
+    def check_lines(cls, reports):
+        """
+        Replace the validation errors of the lines of the reports.
+        The lines are read and the errors inserted by batches with SQL.
+        """
+        pool = Pool()
+        ReportParty = pool.get('aeat.182.report.party')
+        Error = pool.get('aeat.182.report.error')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        read_cursor = transaction.connection.cursor()
+        line = ReportParty.__table__()
+        error = Error.__table__()
+
+        names = ReportParty._checked_fields()
+        for report in reports:
+            cursor.execute(*error.delete(where=error.report == report.id))
+            read_cursor.execute(*line.select(line.id,
+                    *[Column(line, n) for n in names],
+                    where=line.report == report.id,
+                    order_by=line.id))
+            while True:
+                rows = read_cursor.fetchmany(1000)
+                if not rows:
+                    break
+                cls._insert_check_errors(
+                    (report.id, row[0], dict(zip(names, row[1:])))
+                    for row in rows)
+
+    @classmethod
+    def _insert_check_errors(cls, lines):
+        """
+        Insert by batches the errors of check_values for lines, an iterable
+        of (report id, line id, values of the checked fields).
+        """
+        pool = Pool()
+        ReportParty = pool.get('aeat.182.report.party')
+        Error = pool.get('aeat.182.report.error')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        error = Error.__table__()
+
+        columns = [error.create_uid, error.create_date, error.report,
+            error.line, error.party_vat, error.field, error.value,
+            error.message]
+        messages = {}
+
+        def message(name):
+            if name not in messages:
+                messages[name] = gettext('aeat_182.%s' % name)
+            return messages[name]
+
+        values = []
+        for report_id, line_id, line_values in lines:
+            for name, msg_id, value in ReportParty.check_values(line_values):
+                values.append([transaction.user, CurrentTimestamp(),
+                        report_id, line_id, line_values['party_vat'], name,
+                        str(value) if value is not None else None,
+                        message(msg_id)])
+        for sub_values in grouped_slice(values, max(1,
+                    transaction.database.IN_MAX // len(columns))):
+            cursor.execute(*error.insert(columns, list(sub_values)))
+
+    @classmethod
+    @ModelView.button_action('aeat_182.wizard_report_correct')
+    def correct(cls, reports):
+        pass
+
+    def get_delta(self, report_parties):
+        '''
+        Compare the lines of the report with report_parties, the values of
+        a new calculation, by party VAT and key.
+        Return the lists of values added and changed and the list of
+        (party VAT, key, amount) removed.
+        '''
+        ReportParty = Pool().get('aeat.182.report.party')
+        cursor = Transaction().connection.cursor()
+        table = ReportParty.__table__()
+
+        filed = {}
+        cursor.execute(*table.select(table.party_vat, table.key,
+                Sum(table.amount),
+                where=table.report == self.id,
+                group_by=[table.party_vat, table.key]))
+        for vat, key, amount in cursor.fetchall():
+            # SQLite uses float for SUM
+            if not isinstance(amount, Decimal):
+                amount = Decimal(str(amount))
+            filed[(vat, key)] = amount
+
+        amounts = defaultdict(Decimal)
+        for values in report_parties:
+            amounts[(values['party_vat'], values['key'])] += values['amount']
+        added, changed = [], []
+        for values in report_parties:
+            key = (values['party_vat'], values['key'])
+            if key not in filed:
+                added.append(values)
+            elif amounts[key] != filed[key]:
+                changed.append(values)
+        removed = [(vat, key, amount) for (vat, key), amount in filed.items()
+            if (vat, key) not in amounts]
+        return added, removed, changed
+
+    def get_correction(self):
+        "Return the values of a new calculation and its delta with the report"
+        if not self.accounts or not self.fiscalyear:
+            raise UserError(gettext('aeat_182.msg_correction_no_calculation',
+                    report=self.rec_name))
+        report_parties = self.get_report_parties(self.fiscalyear)
+        self.set_percentage_deductions(report_parties)
+        return report_parties, self.get_delta(report_parties)
+
+    def create_correction(self, type_, declaration_number):
+        '''
+        Create a calculated report of type_ correcting the report.
+        A complementary report holds only the donors added since the report
+        was filed and a substitutive report holds all the donors.
+        '''
+        Date = Pool().get('ir.date')
+
+        report_parties, (added, removed, changed) = self.get_correction()
+        if type_ == 'C':
+            if removed or changed:
+                raise UserError(gettext(
+                        'aeat_182.msg_correction_complementary_changes',
+                        report=self.rec_name))
+            report_parties = added
+        correction, = self.copy([self], default={
+                'type': type_,
+                'declaration_number': declaration_number,
+                'previous_number': self.declaration_number,
+                'state': 'calculated',
+                'date': Date.today(),
+                'last_calculation': self.get_donation_watermark(
+                    self.fiscalyear),
+                'report_parties': None,
+                'file_': None,
+                'file_id': None,
+                'archive': None,
+                'archive_id': None,
+                'certificates': None,
+                'certificates_id': None,
+                'export': None,
+                'export_id': None,
+                'export_format': None,
+                'stats': None,
+                })
+        for vlist in grouped_slice(report_parties):
+            vlist = list(vlist)
+            for values in vlist:
+                values['report'] = correction.id
+            self._create_lines(vlist)
+        return correction
+
+    def get_file_records(self):
+        "Yield the retrofix records of the file reading lines by chunks"
+        ReportParty = Pool().get('aeat.182.report.party')
+
+        fields = ('fiscalyear_code', 'company_vat', 'company_name', 'type',
+            'support_type', 'company_phone', 'contact_name', 'nature',
+            'declaration_number', 'protected_heritage_name',
+            'previous_number', 'total_number_of_donor_records',
+            'amount_of_donations', 'protected_heritage_vat')
+
+        record = Record(aeat182.PRESENTER_RECORD)
+        for field in fields:
+            value = getattr(self, field, None)
+            if field == 'type':
+                if value != 'N':
+                    for v in DONATION_TYPE:
+                        if value == v[0]:
+                            setattr(record, v[1].lower(), value)
+                            break
+                continue
+            if isinstance(value, (int, float, Decimal)):
+                value = str(value)
+            if value is not None:
+                setattr(record, field, value)
+        yield record
+
+        fiscalyear_code = str(self.fiscalyear_code)
+        party_ids = [p.id for p in ReportParty.search([
+                    ('report', '=', self.id),
+                    ], order=[('id', 'ASC')])]
+        self.set_progress(0, len(party_ids))
+        processed = 0
+        for sub_ids in grouped_slice(party_ids):
+            sub_ids = list(sub_ids)
+            with phase('get_record') as result:
+                records = ReportParty.get_records(sub_ids)
+                for record in records:
+                    record.fiscalyear_code = fiscalyear_code
+                    record.company_vat = self.company_vat
+                result['rows'] = len(records)
+            for record in records:
+                yield record
+            processed += len(sub_ids)
+            self.set_progress(processed)
+
+    def write_file(self, file_):
+        "Write the encoded file content into file_ record by record"
+        for record in self.get_file_records():
+            file_.write(aeat_encode(retrofix_write([record])))
+
+    def create_file(self):
+        '''
+        Generate the file and store it in the filestore.
+        The filestore is addressed by content so generating again an
+        identical file does not write it again.
+        '''
+        with instrument('create_file') as stats:
+            with tempfile.TemporaryFile() as file_:
+                self.write_file(file_)
+                self.file_id = set_file(
+                    file_, get_prefix(self.__class__.file_))
+        self.archive = None
+        if stats is not None:
+            self.stats = stats.summary()
+        self.save()
+
+    @classmethod
+    @ModelView.button
+    def archive_file(cls, reports):
+        "Store a gzip compressed copy of the file of the reports"
+        for report in reports:
+            if report.state != 'done' or not report.file_id:
+                continue
+            archive = io.BytesIO()
+            # Without modification time the same file gives the same archive
+            with gzip.GzipFile(fileobj=archive, mode='wb', mtime=0) as file_:
+                file_.write(report.file_)
+            report.archive = cls.archive.cast(archive.getvalue())
+        cls.save(reports)
+
+    @classmethod
+    def archive_past_files(cls):
+        "Archive the files of the done reports of past fiscal years"
+        Date = Pool().get('ir.date')
+        reports = cls.search([
+                ('state', '=', 'done'),
+                ('file_id', '!=', None),
+                ('archive_id', '=', None),
+                ('fiscalyear_code', '<', Date.today().year),
+                ])
+        cls.archive_file(reports)
+
+    @classmethod
+    @ModelView.button_action('aeat_182.wizard_report_certificates')
+    def donor_certificates(cls, reports):
+        pass
+
+    @classmethod
+    def generate_certificates(cls, reports, merge=False):
+        """
+        Generate the certificates of reports.
+        With the task queue enabled each chunk of lines is rendered by its own
+        task and the last task to finish assembles the archive.
+        """
+        if cls.use_queue():
+            cls.queue_certificates(reports, merge)
+        else:
+            cls.create_certificates(reports, merge)
+
+    @classmethod
+    def create_certificates(cls, reports, merge=False):
+        for report in reports:
+            report.create_certificates_file(merge)
+
+    @classmethod
+    def queue_certificates(cls, reports, merge=False):
+        "Queue a task to render each chunk of lines of the reports"
+        Part = Pool().get('aeat.182.report.certificate.part')
+        # The pending tasks of a previous generation find no part to render
+        Part.delete(Part.search([
+                    ('report', 'in', [r.id for r in reports]),
+                    ]))
+        for report in reports:
+            chunks = list(report.get_certificate_chunks())
+            if not chunks:
+                report.create_certificates_file(merge)
+                continue
+            parts = Part.create([{
+                        'report': report.id,
+                        'number': number,
+                        'merge': merge,
+                        } for number in range(1, len(chunks) + 1)])
+            with Transaction().set_context(queue_name='aeat_182'):
+                for part, line_ids in zip(parts, chunks):
+                    cls.__queue__.run_task([report], 'render_certificates',
+                        part.id, line_ids)
+
+    @classmethod
+    def render_certificates(cls, reports, part_id, line_ids):
+        """
+        Render the certificates of the lines of a part and assemble the
+        archive of the report if all its parts are rendered.
+        """
+        pool = Pool()
+        Part = pool.get('aeat.182.report.certificate.part')
+        ReportParty = pool.get('aeat.182.report.party')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        report, = reports
+
+        parts = Part.search([('id', '=', part_id)])
+        if not parts:
+            return
+        part, = parts
+        lines = ReportParty.search([
+                ('id', 'in', line_ids),
+                ], order=[('party_vat', 'ASC'), ('id', 'ASC')])
+        with instrument('render_certificates'):
+            with tempfile.TemporaryFile() as file_:
+                with zipfile.ZipFile(
+                        file_, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    report.write_certificates_chunk(
+                        archive, lines, part.number, part.merge)
+                part.file_id = set_file(file_, get_prefix(Part.file_))
+        part.save()
+
+        # Updating the report serializes the tasks of its parts, so the last
+        # one to finish sees all the parts rendered
+        cursor.execute(*table.update(
+                [table.write_date], [CurrentTimestamp()],
+                where=table.id == report.id))
+        if not Part.search([
+                    ('report', '=', report.id),
+                    ('file_id', '=', None),
+                    ]):
+            report.assemble_certificates()
+
+    def assemble_certificates(self):
+        "Store the documents of the rendered parts in the certificates archive"
+        Part = Pool().get('aeat.182.report.certificate.part')
+        parts = Part.search([
+                ('report', '=', self.id),
+                ], order=[('number', 'ASC')])
+        prefix = get_prefix(Part.file_)
+        with instrument('assemble_certificates'):
+            with tempfile.TemporaryFile() as file_:
+                with zipfile.ZipFile(
+                        file_, 'w', zipfile.ZIP_DEFLATED) as archive:
+                    for part in parts:
+                        with open_file(part.file_id, prefix) as part_file, \
+                                zipfile.ZipFile(part_file) as part_archive:
+                            for name in part_archive.namelist():
+                                with part_archive.open(name) as source, \
+                                        archive.open(name, 'w') as target:
+                                    shutil.copyfileobj(source, target)
+                self.certificates_id = set_file(
+                    file_, get_prefix(self.__class__.certificates))
+        self.save()
+        Part.delete(parts)
+
+    def get_certificate_chunks(self):
+        "Yield the ids of the lines by chunks of certificate_chunk lines"
+        ReportParty = Pool().get('aeat.182.report.party')
+        size = config.getint('aeat_182', 'certificate_chunk', default=500)
+        party_ids = [p.id for p in ReportParty.search([
+                    ('report', '=', self.id),
+                    ], order=[('party_vat', 'ASC'), ('id', 'ASC')])]
+        for sub_ids in grouped_slice(party_ids, size):
+            yield list(sub_ids)
+
+    def write_certificates_chunk(self, archive, lines, number, merge=False):
+        """
+        Write into the zip archive the donation certificates of the chunk
+        number of lines, one document per line or, with merge, one for the
+        chunk.
+        """
+        Certificate = Pool().get('aeat.182.report.party.certificate',
+            type='report')
+        action = Certificate.get_action()
+        with phase('certificates') as result:
+            if merge:
+                oext, content = Certificate.render_lines(lines, action)
+                archive.writestr(
+                    'certificates-%04d.%s' % (number, oext), content)
+            else:
+                for line in lines:
+                    oext, content = Certificate.render_lines([line], action)
+                    archive.writestr('%s.%s' % (slugify(
+                                '%s-%s-%s' % (line.party_vat,
+                                    line.key, line.id)), oext),
+                        content)
+            result['rows'] = len(lines)
+
+    def write_certificates(self, file_, merge=False):
+        """
+        Write into file_ the zip archive with the donation certificates of
+        the lines, one document per line or, with merge, one per chunk of
+        lines.
+        The lines are read and rendered by chunks and each document is
+        written to the archive once rendered.
+        """
+        ReportParty = Pool().get('aeat.182.report.party')
+        with zipfile.ZipFile(file_, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for number, line_ids in enumerate(
+                    self.get_certificate_chunks(), 1):
+                self.write_certificates_chunk(archive,
+                    ReportParty.browse(line_ids), number, merge)
+
+    def create_certificates_file(self, merge=False):
+        with instrument('create_certificates'):
+            with tempfile.TemporaryFile() as file_:
+                self.write_certificates(file_, merge)
+                self.certificates_id = set_file(
+                    file_, get_prefix(self.__class__.certificates))
+        self.save()
+
+    @classmethod
+    @ModelView.button_action('aeat_182.wizard_report_export')
+    def export_lines(cls, reports):
+        pass
+
+    @classmethod
+    def create_export(cls, reports, format_='csv'):
+        "Export the lines of reports to a file of format_, csv or xlsx"
+        if format_ == 'xlsx' and openpyxl is None:
+            raise UserError(gettext('aeat_182.msg_export_xlsx_missing'))
+        for report in reports:
+            with instrument('create_export'):
+                with tempfile.TemporaryFile() as file_:
+                    report.write_export(file_, format_)
+                    report.export_id = set_file(
+                        file_, get_prefix(cls.export))
+            report.export_format = format_
+        cls.save(reports)
+
+    def get_export_rows(self):
+        """
+        Yield the header, the values of each line and the totals by nature
+        and of the report.
+        The lines are fetched by chunks with a server-side cursor on
+        PostgreSQL so the memory used does not depend on the number of
+        lines.
+        """
+        ReportParty = Pool().get('aeat.182.report.party')
+        connection = Transaction().connection
+        line = ReportParty.__table__()
+        size = max(1, Transaction().database.IN_MAX)
+
+        names = ReportParty._export_fields()
+        yield [ReportParty._fields[n].string for n in names]
+
+        if backend.name == 'postgresql':
+            cursor = connection.cursor('aeat_182_export')
+            cursor.itersize = size
+        else:
+            cursor = connection.cursor()
+        cursor.execute(*line.select(*[Column(line, n) for n in names],
+                where=line.report == self.id,
+                order_by=[line.party_vat.asc, line.id.asc]))
+
+        amount_index = names.index('amount')
+        nature_index = names.index('nature')
+        totals = defaultdict(lambda: [0, Decimal(0)])
+        total = [0, Decimal(0)]
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            with phase('export') as result:
+                for row in rows:
+                    row = [self._export_value(ReportParty._fields[n], v)
+                        for n, v in zip(names, row)]
+                    for counter in [totals[row[nature_index]], total]:
+                        counter[0] += 1
+                        counter[1] += row[amount_index] or 0
+                    yield row
+                result['rows'] = len(rows)
+        cursor.close()
+
+        for nature, (number, amount) in sorted(totals.items(),
+                key=lambda t: t[0] or ''):
+            row = [None] * len(names)
+            row[0] = gettext('aeat_182.msg_export_total_nature',
+                nature=nature or '', number=number)
+            row[nature_index] = nature
+            row[amount_index] = amount
+            yield row
+        row = [None] * len(names)
+        row[0] = gettext('aeat_182.msg_export_total', number=total[0])
+        row[amount_index] = total[1]
+        yield row
+
+    @staticmethod
+    def _export_value(field, value):
+        if value is None:
+            return None
+        if isinstance(field, fields.Numeric) and not isinstance(
+                value, Decimal):
+            # SQLite returns float for numeric
+            value = Decimal(str(value))
+        elif isinstance(field, fields.Boolean):
+            value = bool(value)
+        return value
+
+    def write_export(self, file_, format_='csv'):
+        "Write into the binary file_ the rows of the lines as format_"
+        rows = self.get_export_rows()
+        if format_ == 'xlsx':
+            workbook = openpyxl.Workbook(write_only=True)
+            worksheet = workbook.create_sheet()
+            for row in rows:
+                worksheet.append(row)
+            workbook.save(file_)
+        else:
+            text = io.TextIOWrapper(file_, encoding='utf-8', newline='')
+            writer = csv.writer(text)
+            for row in rows:
+                writer.writerow(row)
+            text.flush()
+            # Keep file_ open
+            text.detach()
+
+
+class ReportAccount(ModelSQL):
+    'AEAT 182 Report Account'
+    __name__ = 'aeat.182.report.account'
     report = fields.Many2One('aeat.182.report', 'Report', required=True,
         ondelete='CASCADE')
+    account = fields.Many2One('account.account', 'Account', required=True,
+        ondelete='CASCADE')
+
+
+class ReportProgress(ModelSQL):
+    'AEAT 182 Report Progress'
+    __name__ = 'aeat.182.report.progress'
+    report = fields.Many2One('aeat.182.report', 'Report', required=True,
+        ondelete='CASCADE', select=True)
+    processed = fields.Integer('Processed')
+    total = fields.Integer('Total')
+
+
+class ReportCertificatePart(ModelSQL):
+    'AEAT 182 Report Certificate Part'
+    __name__ = 'aeat.182.report.certificate.part'
+    report = fields.Many2One('aeat.182.report', 'Report', required=True,
+        ondelete='CASCADE', select=True)
+    number = fields.Integer('Number', required=True)
+    merge = fields.Boolean('Merge')
+    file_ = fields.Binary('File', file_id='file_id')
+    file_id = fields.Char('File ID', readonly=True)
+
+
+class ReportParty(ModelSQL, ModelView):
+    'AEAT 182 Report Party'
+    __name__ = 'aeat.182.report.party'
+    report = fields.Many2One('aeat.182.report', 'Report', required=True,
+        ondelete='CASCADE', select=True)
     company = fields.Function(fields.Many2One('company.company', 'Company'),
         'on_change_with_company', searcher='search_company')
     party = fields.Many2One('party.party', 'Party',
         states={
             'required': True,
-            })
-    party_vat = fields.Char('Party VAT')
+            }, select=True)
+    party_vat = fields.Char('Party VAT', select=True)
     representative_vat = fields.Char('Representative VAT')
     party_name = fields.Char('Party Name')
     nature = fields.Selection([
@@ -616,6 +2254,7 @@ class ReportParty(ModelSQL, ModelView):
         states={
             'required': True,
             })
+    key_string = key.translated('key')
     currency_digits = fields.Function(fields.Integer('Currency Digits'),
             'get_currency_digits')
     percentage_deduction = fields.Numeric('Deduction',
@@ -650,15 +2289,40 @@ class ReportParty(ModelSQL, ModelView):
         states={
             'invisible': Not(Bool(Eval('type_of_good'))),
             }, depends=['type_of_good'])
+    donation_lines = fields.Integer('Donation Lines', readonly=True,
+        help='The number of donation lines of the last calculation.')
+
+    @staticmethod
+    def _calculated_fields():
+        """
+        Fields updated by the recalculation of the report, the identity of
+        the donor may be edited manually so it is kept
+        """
+        return ['nature', 'party_subdivision_code', 'amount',
+            'percentage_deduction', 'donation_lines']
 
     def get_rec_name(self, name):
         report = self.report.rec_name + ':' if self.report else ''
         return "%s %s-%s" % (report, self.party_name, self.key)
 
+    @classmethod
+    def search_rec_name(cls, name, clause):
+        if clause[1].startswith('!') or clause[1].startswith('not '):
+            bool_op = 'AND'
+        else:
+            bool_op = 'OR'
+        return [bool_op,
+            ('party_vat',) + tuple(clause[1:]),
+            ('party_name',) + tuple(clause[1:]),
+            ]
+
     @classmethod
     def get_currency_digits(cls, records, name=None):
-        res = {r.id: r.report.currency.digits for r in records}
-        return res
+        Report = Pool().get('aeat.182.report')
+        # Resolve the currency once per report instead of once per line
+        reports = Report.browse({r.report.id for r in records})
+        digits = Report.get_currency_digits(reports)
+        return {r.id: digits[r.report.id] for r in records}
 
     @fields.depends('report', '_parent_report.company')
     def on_change_with_company(self, name=None):
@@ -669,18 +2333,911 @@ class ReportParty(ModelSQL, ModelView):
     def search_company(cls, name, clause):
         return [('report.%s' % name,) + tuple(clause[1:])]
 
-    def get_record(self):
-        fields = ('party_vat', 'representative_vat', 'party_name',
+    @classmethod
+    def values_from_record(cls, record):
+        '''
+        Return the values of a line from a retrofix PARTY_RECORD.
+        Raise ValueError if the record is not valid.
+        '''
+        def percentage(value):
+            # 3 integer and 2 decimal digits
+            return Decimal(int(value)) / 100
+
+        def flag(value):
+            # The AEAT uses X but get_record writes the first letter of True
+            return value in {'X', 'T'}
+
+        party_vat = record.party_vat.strip()
+        if not party_vat:
+            raise ValueError(gettext('aeat_182.msg_import_missing_party_vat'))
+        key = record.key.strip()
+        if key not in dict(KEY):
+            raise ValueError(gettext('aeat_182.msg_import_invalid_value',
+                    field='key', value=key))
+        nature = record.nature.strip()
+        if nature not in dict(cls.nature.selection):
+            raise ValueError(gettext('aeat_182.msg_import_invalid_value',
+                    field='nature', value=nature))
+        community = record.deduction_autonomous_community
+        if community == '00':
+            community = None
+        elif community not in dict(AUTONOMOUS_COMUNITY):
+            raise ValueError(gettext('aeat_182.msg_import_invalid_value',
+                    field='deduction_autonomous_community', value=community))
+        return {
+            'party_vat': party_vat,
+            'representative_vat': record.representative_vat.strip() or None,
+            'party_name': record.party_name.strip(),
+            'party_subdivision_code': record.party_subdivision_code,
+            'key': key,
+            'percentage_deduction': percentage(record.percentage_deduction),
+            'amount': record.amount,
+            'donation_in_kind': flag(record.donation_in_kind),
+            'deduction_autonomous_community': community,
+            'percentage_deduction_autonomous_community': (
+                percentage(record.percentage_deduction_autonomous_community)
+                if community else None),
+            'nature': nature,
+            'revocation': flag(record.revocation),
+            'exercise_of_the_revoked_donation': int(
+                record.exercise_of_the_revoked_donation) or None,
+            'type_of_good': record.type_of_good.strip() or None,
+            'identification_of_good': (
+                record.identification_of_good.strip() or None),
+            }
+
+    @staticmethod
+    def _export_fields():
+        "Fields of the lines exported, in the order of the columns"
+        return ['party_vat', 'party_name', 'representative_vat', 'nature',
+            'party_subdivision_code', 'key', 'amount',
+            'percentage_deduction', 'deduction_autonomous_community',
+            'percentage_deduction_autonomous_community', 'donation_in_kind',
+            'revocation', 'exercise_of_the_revoked_donation', 'type_of_good',
+            'identification_of_good']
+
+    @staticmethod
+    def _checked_fields():
+        "Fields read by check_values"
+        return ['party_vat', 'representative_vat', 'party_name', 'nature',
+            'party_subdivision_code', 'key', 'percentage_deduction',
+            'amount', 'donation_in_kind', 'deduction_autonomous_community',
+            'percentage_deduction_autonomous_community', 'revocation',
+            'exercise_of_the_revoked_donation', 'type_of_good',
+            'identification_of_good']
+
+    @classmethod
+    def check_values(cls, values):
+        '''
+        Yield (field name, message id, value) for each error of values, the
+        dictionary of the _checked_fields of a line.
+        '''
+        for name in ['party_vat', 'representative_vat']:
+            vat = values[name]
+            if name == 'party_vat' and not vat:
+                yield name, 'msg_check_required', vat
+            elif vat and not es_nif.is_valid(vat):
+                yield name, 'msg_check_vat', vat
+
+        party_name = values['party_name']
+        if not party_name or not party_name.strip():
+            yield 'party_name', 'msg_check_required', party_name
+        else:
+            invalid = {c for c in party_name
+                if c != ' ' and _aeat_charset_table[ord(c)] == ' '}
+            if invalid:
+                yield ('party_name', 'msg_check_charset',
+                    ''.join(sorted(invalid)))
+
+        if values['party_subdivision_code'] not in PROVINCE_CODES:
+            yield ('party_subdivision_code', 'msg_check_province',
+                values['party_subdivision_code'])
+        if values['nature'] not in {'F', 'J', 'E'}:
+            yield 'nature', 'msg_check_required', values['nature']
+        if values['amount'] is None or values['amount'] <= 0:
+            yield 'amount', 'msg_check_amount', values['amount']
+
+        community = values['deduction_autonomous_community']
+        if community and community not in dict(AUTONOMOUS_COMUNITY):
+            yield 'deduction_autonomous_community', 'msg_check_invalid', (
+                community)
+        for name, required in [
+                ('percentage_deduction', values['nature'] in {'F', 'J'}),
+                ('percentage_deduction_autonomous_community',
+                    bool(community)),
+                ]:
+            percentage = values[name]
+            if percentage is None:
+                if required:
+                    yield name, 'msg_check_required', percentage
+            elif not 0 <= percentage <= 100:
+                yield name, 'msg_check_percentage', percentage
+
+        in_kind = values['key'] in {'C', 'D'} or values['donation_in_kind']
+        type_of_good = values['type_of_good']
+        if in_kind and not type_of_good:
+            yield 'type_of_good', 'msg_check_required', type_of_good
+        elif not in_kind and type_of_good:
+            yield 'type_of_good', 'msg_check_not_allowed', type_of_good
+        identification = {
+            'I': 'NRC',
+            'V': 'ISIN',
+            }.get(type_of_good)
+        if identification != values['identification_of_good']:
+            yield ('identification_of_good', 'msg_check_invalid',
+                values['identification_of_good'])
+        if values['revocation']:
+            if values['key'] not in {'A', 'B'}:
+                yield 'revocation', 'msg_check_not_allowed', values['key']
+            if not values['exercise_of_the_revoked_donation']:
+                yield ('exercise_of_the_revoked_donation',
+                    'msg_check_required',
+                    values['exercise_of_the_revoked_donation'])
+
+    @staticmethod
+    def _record_fields():
+        "Fields written in the PARTY_RECORD of the file"
+        return ['party_vat', 'representative_vat', 'party_name',
             'party_subdivision_code', 'key', 'percentage_deduction',
             'identification_of_good', 'deduction_autonomous_community',
             'amount', 'donation_in_kind', 'exercise_of_the_revoked_donation',
             'percentage_deduction_autonomous_community', 'nature',
-            'revocation', 'type_of_good')
+            'revocation', 'type_of_good']
+
+    @classmethod
+    def record_from_values(cls, values):
+        "Return the retrofix PARTY_RECORD of values of the _record_fields"
         record = Record(aeat182.PARTY_RECORD)
-        for field in fields:
-            value = getattr(self, field, None)
+        for field in cls._record_fields():
+            value = values.get(field)
             if isinstance(value, (int, float, Decimal)):
                 value = str(value)
             if value is not None:
                 setattr(record, field, value)
         return record
+
+    @classmethod
+    def get_records(cls, ids):
+        """
+        Return the retrofix PARTY_RECORD of the lines of ids in the same
+        order, reading their values at once.
+        """
+        values = {v['id']: v for v in cls.read(ids, cls._record_fields())}
+        return [cls.record_from_values(values[i]) for i in ids]
+
+    def get_record(self):
+        return self.get_records([self.id])[0]
+
+
+class DeductionRate(ModelSQL, ModelView):
+    'AEAT 182 Deduction Rate'
+    __name__ = 'aeat.182.deduction.rate'
+    company = fields.Many2One('company.company', 'Company', select=True,
+        help='The company of the rate, empty for the rates of every '
+        'company.')
+    start_year = fields.Integer('Start Year', required=True,
+        help='The first fiscal year of the rate, it applies until the next '
+        'start year of the same nature and pluriannual donation.')
+    nature = fields.Selection([
+            ('F', '[F]. Physical person'),
+            ('J', '[J]. Artificial person'),
+            ], 'Nature', required=True)
+    pluriannual = fields.Boolean('Pluriannual Donation')
+    over_amount = fields.Numeric('Over Amount', digits=(16, 2),
+        required=True,
+        help='The rate applies to the donations of a greater amount, up to '
+        'the next over amount.')
+    percentage = fields.Numeric('Percentage', digits=(16, 2), required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(DeductionRate, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('rate_uniq',
+                Unique(t, t.company, t.start_year, t.nature, t.pluriannual,
+                    t.over_amount),
+                'The deduction rate must be unique by company, start year, '
+                'nature, pluriannual donation and over amount.'),
+            ]
+        cls._order.insert(0, ('start_year', 'DESC'))
+        cls._order.insert(1, ('nature', 'ASC'))
+        cls._order.insert(2, ('pluriannual', 'ASC'))
+        cls._order.insert(3, ('over_amount', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Report = pool.get('aeat.182.report')
+
+        created = not backend.TableHandler.table_exist(cls._table)
+
+        super(DeductionRate, cls).__register__(module_name)
+
+        # Migration from 5.8: replace the rates of the reports
+        report_h = Report.__table_handler__(module_name)
+        if created and report_h.column_exist('donation_amount_threshold'):
+            cls._migrate_report_rates()
+
+    @classmethod
+    def _migrate_report_rates(cls):
+        """
+        Create the rates of the companies from the threshold and percentages
+        of their reports, for each fiscal year they differ from the previous
+        one or, for the first one, from the rates loaded by the module.
+        """
+        pool = Pool()
+        Report = pool.get('aeat.182.report')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        report = Report.__table__()
+        table = cls.__table__()
+
+        names = ['donation_amount_threshold',
+            'first_less_physical', 'first_greater_physical',
+            'pluriannual_physical',
+            'first_less_artificial', 'first_greater_artificial',
+            'pluriannual_artificial']
+        defaults = tuple(Decimal(v) for v in [150, 75, 30, 35, 35, 35, 40])
+        cursor.execute(*report.select(
+                report.company, report.fiscalyear_code,
+                *[Column(report, n) for n in names],
+                where=((Column(report, names[0]) != Null)
+                    & (report.fiscalyear_code != Null)),
+                order_by=[report.id.asc]))
+        # The last report of the year wins
+        rates_by_year = {(c, y): tuple(r) for c, y, *r in cursor.fetchall()}
+
+        values = []
+        previous = {}
+        for company, year in sorted(rates_by_year):
+            rates = rates_by_year[company, year]
+            if previous.get(company, defaults) == rates:
+                continue
+            previous[company] = rates
+            (threshold, less_physical, greater_physical, pluriannual_physical,
+                less_artificial, greater_artificial,
+                pluriannual_artificial) = rates
+            # The rate of an amount equal to the threshold is the lower one
+            bands = [
+                ('F', False, less_physical, greater_physical),
+                ('F', True, less_physical, pluriannual_physical),
+                ('J', False, less_artificial, greater_artificial),
+                ('J', True, pluriannual_artificial, pluriannual_artificial),
+                ]
+            for nature, pluriannual, lower, upper in bands:
+                over_amounts = [(Decimal(0), lower), (threshold, upper)]
+                if lower == upper or threshold <= 0:
+                    over_amounts = [(Decimal(0), upper)]
+                for over_amount, percentage in over_amounts:
+                    if percentage is None:
+                        continue
+                    values.append([transaction.user, CurrentTimestamp(),
+                            company, year, nature, pluriannual, over_amount,
+                            percentage])
+        columns = [table.create_uid, table.create_date, table.company,
+            table.start_year, table.nature, table.pluriannual,
+            table.over_amount, table.percentage]
+        for sub_values in grouped_slice(values, max(1,
+                    transaction.database.IN_MAX // len(columns))):
+            cursor.execute(*table.insert(columns, list(sub_values)))
+
+    @staticmethod
+    def default_pluriannual():
+        return False
+
+    @staticmethod
+    def default_over_amount():
+        return Decimal(0)
+
+    @classmethod
+    def get_rates(cls, fiscalyear_code, company=None):
+        """
+        Return the rates which apply to fiscalyear_code, those of the last
+        start year not greater than it for each nature and pluriannual
+        donation.
+        With a company, its rates take precedence over the rates of every
+        company of the same start year.
+        """
+        domain = [
+            ('start_year', '<=', fiscalyear_code),
+            ]
+        if company:
+            domain.append(['OR',
+                    ('company', '=', None),
+                    ('company', '=', company.id),
+                    ])
+        else:
+            domain.append(('company', '=', None))
+        versions = {}
+        rates = []
+        for rate in sorted(cls.search(domain),
+                key=lambda r: (-r.start_year, r.company is None)):
+            key = (rate.nature, bool(rate.pluriannual))
+            version = (rate.start_year, rate.company)
+            if versions.setdefault(key, version) == version:
+                rates.append(rate)
+        return rates
+
+    @classmethod
+    def get_table(cls, fiscalyear_code, company=None):
+        """
+        Return the rates of fiscalyear_code as a dictionary with the sorted
+        list of over amounts and their percentages by nature and pluriannual
+        donation.
+        """
+        table = {}
+        for rate in sorted(cls.get_rates(fiscalyear_code, company),
+                key=lambda r: r.over_amount):
+            over_amounts, percentages = table.setdefault(
+                (rate.nature, bool(rate.pluriannual)), ([], []))
+            over_amounts.append(rate.over_amount)
+            percentages.append(rate.percentage)
+        return table
+
+    @staticmethod
+    def classify(table, donors):
+        """
+        Return the list of percentages of donors, an iterable of nature,
+        amount and pluriannual donation, from table returned by get_table.
+        The percentage is None when no rate applies to the nature.
+        """
+        percentages = []
+        for nature, amount, pluriannual in donors:
+            over_amounts, rates = table.get(
+                (nature, bool(pluriannual)), ((), ()))
+            if rates:
+                index = max(bisect.bisect_left(over_amounts, amount) - 1, 0)
+                percentages.append(rates[index])
+            else:
+                percentages.append(None)
+        return percentages
+
+
+class DonorHistory(ModelSQL, ModelView):
+    'AEAT 182 Donor History'
+    __name__ = 'aeat.182.donor.history'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    party_vat = fields.Char('Party VAT', required=True)
+    fiscalyear_code = fields.Integer('Fiscal Year Code', required=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), required=True)
+    report = fields.Many2One('aeat.182.report', 'Report', readonly=True,
+        ondelete='SET NULL', select=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(DonorHistory, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('party_vat_uniq',
+                Unique(t, t.company, t.party_vat, t.fiscalyear_code),
+                'The donor history must be unique by company, party VAT and '
+                'fiscal year code.'),
+            ]
+        cls._order.insert(0, ('fiscalyear_code', 'DESC'))
+        cls._order.insert(1, ('party_vat', 'ASC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Report = pool.get('aeat.182.report')
+        cursor = Transaction().connection.cursor()
+        report = Report.__table__()
+
+        created = not backend.TableHandler.table_exist(cls._table)
+
+        super(DonorHistory, cls).__register__(module_name)
+
+        # Migration from 5.6: fill history from existing done reports
+        if created:
+            cursor.execute(*report.select(
+                    report.company, report.fiscalyear_code,
+                    where=report.state == 'done',
+                    group_by=(report.company, report.fiscalyear_code)))
+            cls._update_years(cursor.fetchall())
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def _history_columns(cls, table):
+        "Return the columns of table filled by _history_query"
+        return [table.create_uid, table.create_date, table.company,
+            table.party_vat, table.fiscalyear_code, table.amount,
+            table.report]
+
+    @classmethod
+    def _history_query(cls, report_ids, company_id, year):
+        """
+        Return the query of the amount by donor of the last report of
+        report_ids declaring it, skipping the donors entered manually in the
+        history of the company and year
+        """
+        pool = Pool()
+        Report = pool.get('aeat.182.report')
+        ReportParty = pool.get('aeat.182.report.party')
+        table = cls.__table__()
+        report = Report.__table__()
+        report_party = ReportParty.__table__()
+        line = ReportParty.__table__()
+
+        last = report_party.select(
+            report_party.party_vat.as_('party_vat'),
+            Max(report_party.report).as_('report'),
+            where=(reduce_ids(report_party.report, report_ids)
+                & (report_party.party_vat != Null)
+                & (report_party.party_vat != '')
+                & ~report_party.party_vat.in_(table.select(table.party_vat,
+                        where=((table.company == company_id)
+                            & (table.fiscalyear_code == year))))),
+            group_by=report_party.party_vat)
+        return line.join(last,
+            condition=((line.party_vat == last.party_vat)
+                & (line.report == last.report))
+            ).join(report, condition=line.report == report.id
+            ).select(
+            Literal(Transaction().user), CurrentTimestamp(),
+            report.company, line.party_vat, report.fiscalyear_code,
+            Sum(line.amount), report.id,
+            group_by=(report.id, report.company, report.fiscalyear_code,
+                line.party_vat))
+
+    @classmethod
+    def _update_years(cls, years, done=None, not_done=None):
+        """
+        Replace the history of years, (company id, fiscal year code) pairs,
+        by the amounts of their done reports: those of the last normal or
+        substitutive report and of the complementary reports that follow it,
+        each donor taking the amount of the last one declaring it.
+        done and not_done are the ids of the reports to take as done or not
+        because their state is written after the history is updated.
+        The donors entered manually, without report, are kept.
+        """
+        pool = Pool()
+        Report = pool.get('aeat.182.report')
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        report = Report.__table__()
+        done = set(done or [])
+        not_done = set(not_done or [])
+
+        for company_id, year in set(years):
+            cursor.execute(*report.select(
+                    report.id, report.type, report.state,
+                    where=((report.company == company_id)
+                        & (report.fiscalyear_code == year)),
+                    order_by=report.id.asc))
+            report_ids = []
+            for report_id, type_, state in cursor.fetchall():
+                if (report_id in not_done
+                        or (state != 'done' and report_id not in done)):
+                    continue
+                if type_ != 'C':
+                    report_ids = []
+                report_ids.append(report_id)
+
+            cursor.execute(*table.delete(
+                    where=((table.company == company_id)
+                        & (table.fiscalyear_code == year)
+                        & (table.report != Null))))
+            if report_ids:
+                cursor.execute(*table.insert(cls._history_columns(table),
+                        cls._history_query(report_ids, company_id, year)))
+
+    @classmethod
+    def update_reports(cls, reports):
+        "Update the history of the fiscal years of reports becoming done"
+        cls._update_years(
+            [(r.company.id, r.fiscalyear_code) for r in reports],
+            done=[r.id for r in reports])
+
+    @classmethod
+    def clear_reports(cls, reports):
+        """
+        Update the history of the fiscal years of the done reports leaving
+        this state, restoring the amounts of the reports they replaced
+        """
+        reports = [r for r in reports if r.state == 'done']
+        cls._update_years(
+            [(r.company.id, r.fiscalyear_code) for r in reports],
+            not_done=[r.id for r in reports])
+
+
+class CalculateAllResult(ModelView):
+    'AEAT 182 Calculate All Result'
+    __name__ = 'aeat.182.report.calculate_all.result'
+    summary = fields.Text('Summary', readonly=True)
+    reports = fields.Many2Many('aeat.182.report', None, None, 'Reports',
+        readonly=True)
+
+
+class CalculateAll(Wizard):
+    'AEAT 182 Calculate All'
+    __name__ = 'aeat.182.report.calculate_all'
+    start_state = 'calculate'
+    calculate = StateTransition()
+    result = StateView('aeat.182.report.calculate_all.result',
+        'aeat_182.report_calculate_all_result_view_form', [
+            Button('Refresh', 'refresh', 'tryton-refresh'),
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+    refresh = StateTransition()
+
+    def transition_calculate(self):
+        Report = Pool().get('aeat.182.report')
+
+        reports = Report.browse(Transaction().context.get('active_ids', []))
+        names = {r.id: r.rec_name for r in reports}
+        results = Report.calculate_all(reports)
+        if Report.use_queue():
+            message = 'aeat_182.msg_calculate_all_queued'
+        else:
+            message = 'aeat_182.msg_calculate_all_done'
+        lines = [gettext(message,
+                reports=len([r for r in results if not r[2]]),
+                failed=len([r for r in results if r[2]]),
+                skipped=len(reports) - len(results),
+                seconds='%.2f' % sum(r[1] for r in results))]
+        for report_id, seconds, error in results:
+            lines.append('%s: %.2fs%s' % (names[report_id], seconds,
+                    ' %s' % error if error else ''))
+        self.result.summary = '\n'.join(lines)
+        self.result.reports = [r.id for r in reports]
+        return 'result'
+
+    def transition_refresh(self):
+        "Summarize the current state of the reports and the task errors"
+        Report = Pool().get('aeat.182.report')
+
+        reports = list(self.result.reports)
+        results = Report.calculate_all_status(reports)
+        lines = [gettext('aeat_182.msg_calculate_all_status',
+                calculated=len([r for r in results if r[1] == 'calculated']),
+                running=len([r for r in results if r[1] == 'calculating']),
+                failed=len([r for r in results if r[2]]))]
+        states = dict(Report.fields_get(['state'])['state']['selection'])
+        for report, (_, state, error) in zip(reports, results):
+            lines.append('%s: %s%s' % (report.rec_name, states[state],
+                    ' %s' % error if error else ''))
+        self.result.summary = '\n'.join(lines)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'summary': self.result.summary,
+            'reports': [r.id for r in self.result.reports],
+            }
+
+
+class ImportReportStart(ModelView):
+    'AEAT 182 Import Report Start'
+    __name__ = 'aeat.182.report.import.start'
+    company = fields.Many2One('company.company', 'Company', required=True)
+    file_ = fields.Binary('File', required=True)
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+
+class ImportReportResult(ModelView):
+    'AEAT 182 Import Report Result'
+    __name__ = 'aeat.182.report.import.result'
+    report = fields.Many2One('aeat.182.report', 'Report', readonly=True)
+    errors = fields.Text('Errors', readonly=True)
+
+
+class ImportReport(Wizard):
+    'AEAT 182 Import Report'
+    __name__ = 'aeat.182.report.import'
+    start = StateView('aeat.182.report.import.start',
+        'aeat_182.report_import_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Import', 'import_', 'tryton-ok', default=True),
+            ])
+    import_ = StateTransition()
+    result = StateView('aeat.182.report.import.result',
+        'aeat_182.report_import_result_view_form', [
+            Button('Close', 'end', 'tryton-close'),
+            Button('Open', 'open_', 'tryton-ok', default=True),
+            ])
+    open_ = StateAction('aeat_182.act_aeat_182_report')
+
+    def transition_import_(self):
+        Report = Pool().get('aeat.182.report')
+
+        report, errors = Report.import_file(
+            io.BytesIO(self.start.file_), self.start.company)
+        self.result.report = report
+        self.result.errors = '\n'.join(
+            gettext('aeat_182.msg_import_line_error', line=n, error=e)
+            for n, e in errors)
+        return 'result'
+
+    def default_result(self, fields):
+        return {
+            'report': self.result.report.id,
+            'errors': self.result.errors,
+            }
+
+    def do_open_(self, action):
+        action['res_id'] = [self.result.report.id]
+        action['views'].reverse()
+        return action, {}
+
+
+class CorrectReportStart(ModelView):
+    'AEAT 182 Correct Report Start'
+    __name__ = 'aeat.182.report.correct.start'
+    report = fields.Many2One('aeat.182.report', 'Report', readonly=True)
+    added = fields.Integer('Added Donors', readonly=True)
+    added_amount = fields.Numeric('Added Amount', digits=(16, 2),
+        readonly=True)
+    removed = fields.Integer('Removed Donors', readonly=True)
+    removed_amount = fields.Numeric('Removed Amount', digits=(16, 2),
+        readonly=True)
+    changed = fields.Integer('Changed Donors', readonly=True)
+    changed_amount = fields.Numeric('Changed Amount', digits=(16, 2),
+        readonly=True, help='The new amount of the changed donors.')
+    type = fields.Selection([
+            ('C', 'Complementary'),
+            ('S', 'Substitutive'),
+            ], 'Type', required=True,
+        help='A complementary declaration only adds the donors omitted.')
+    declaration_number = fields.Char('Declaration Number', size=13,
+        required=True)
+
+
+class CorrectReport(Wizard):
+    'AEAT 182 Correct Report'
+    __name__ = 'aeat.182.report.correct'
+    start = StateView('aeat.182.report.correct.start',
+        'aeat_182.report_correct_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Create', 'create_', 'tryton-ok', default=True),
+            ])
+    create_ = StateAction('aeat_182.act_aeat_182_report')
+
+    def default_start(self, fields):
+        Report = Pool().get('aeat.182.report')
+
+        report = Report(Transaction().context['active_id'])
+        _, (added, removed, changed) = report.get_correction()
+        return {
+            'report': report.id,
+            'added': len(added),
+            'added_amount': sum(v['amount'] for v in added),
+            'removed': len(removed),
+            'removed_amount': sum(r[2] for r in removed),
+            'changed': len(changed),
+            'changed_amount': sum(v['amount'] for v in changed),
+            'type': 'S' if removed or changed else 'C',
+            }
+
+    def do_create_(self, action):
+        correction = self.start.report.create_correction(
+            self.start.type, self.start.declaration_number)
+        action['res_id'] = [correction.id]
+        action['views'].reverse()
+        return action, {}
+
+
+class DonorCertificate(CompanyReport):
+    'AEAT 182 Donor Certificate'
+    __name__ = 'aeat.182.report.party.certificate'
+
+    @classmethod
+    def get_action(cls):
+        ActionReport = Pool().get('ir.action.report')
+        action, = ActionReport.search([
+                ('report_name', '=', cls.__name__),
+                ], limit=1)
+        return action
+
+    @classmethod
+    def render_lines(cls, lines, action):
+        "Return the extension and the content of the certificate of lines"
+        return cls._execute(lines, {}, action)
+
+
+class CertificatesStart(ModelView):
+    'AEAT 182 Certificates Start'
+    __name__ = 'aeat.182.report.certificates.start'
+    merge = fields.Boolean('Merge',
+        help='Merge the certificates of each chunk of donors in one '
+        'document instead of one document per donor.')
+
+
+class Certificates(Wizard):
+    'AEAT 182 Certificates'
+    __name__ = 'aeat.182.report.certificates'
+    start = StateView('aeat.182.report.certificates.start',
+        'aeat_182.report_certificates_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Generate', 'generate', 'tryton-ok', default=True),
+            ])
+    generate = StateTransition()
+
+    def transition_generate(self):
+        Report = Pool().get('aeat.182.report')
+        reports = Report.browse(Transaction().context['active_ids'])
+        Report.generate_certificates(reports, self.start.merge)
+        return 'end'
+
+
+class ExportStart(ModelView):
+    'AEAT 182 Export Start'
+    __name__ = 'aeat.182.report.export.start'
+    format_ = fields.Selection([
+            ('csv', 'CSV'),
+            ('xlsx', 'XLSX'),
+            ], 'Format', required=True)
+
+    @staticmethod
+    def default_format_():
+        return 'csv'
+
+
+class Export(Wizard):
+    'AEAT 182 Export'
+    __name__ = 'aeat.182.report.export'
+    start = StateView('aeat.182.report.export.start',
+        'aeat_182.report_export_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-ok', default=True),
+            ])
+    export = StateTransition()
+
+    def transition_export(self):
+        Report = Pool().get('aeat.182.report')
+        reports = Report.browse(Transaction().context['active_ids'])
+        Report.create_export(reports, self.start.format_)
+        return 'end'
+
+
+class PreviewStart(ModelView):
+    'AEAT 182 Preview Start'
+    __name__ = 'aeat.182.report.preview.start'
+    report = fields.Many2One('aeat.182.report', 'Report', readonly=True)
+    donors = fields.Integer('Donors', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    summary = fields.One2Many('aeat.182.report.preview.summary', None,
+        'Summary', readonly=True)
+    first_donors = fields.One2Many('aeat.182.report.preview.donor', None,
+        'Donors of Greater Amount', readonly=True)
+
+
+class PreviewSummary(ModelView):
+    'AEAT 182 Preview Summary'
+    __name__ = 'aeat.182.report.preview.summary'
+    group = fields.Selection([
+            ('nature', 'Nature'),
+            ('band', 'Deduction Band'),
+            ('province', 'Province'),
+            ], 'Group', readonly=True)
+    value = fields.Char('Value', readonly=True)
+    donors = fields.Integer('Donors', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+
+
+class PreviewDonor(ModelView):
+    'AEAT 182 Preview Donor'
+    __name__ = 'aeat.182.report.preview.donor'
+    party_vat = fields.Char('Party VAT', readonly=True)
+    party_name = fields.Char('Party Name', readonly=True)
+    nature = fields.Char('Nature', readonly=True)
+    party_subdivision_code = fields.Char('Party Subdivision Code',
+        readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+    percentage_deduction = fields.Numeric('Deduction', digits=(16, 2),
+        readonly=True)
+
+
+class Preview(Wizard):
+    'AEAT 182 Preview'
+    __name__ = 'aeat.182.report.preview'
+    start = StateView('aeat.182.report.preview.start',
+        'aeat_182.report_preview_start_view_form', [
+            Button('Close', 'end', 'tryton-close', default=True),
+            ])
+
+    def default_start(self, fields):
+        Report = Pool().get('aeat.182.report')
+
+        report = Report(Transaction().context['active_id'])
+        figures = Report.preview([report])[report.id]
+        summary = []
+        for values in figures['natures']:
+            summary.append({
+                    'group': 'nature',
+                    'value': values['nature'],
+                    })
+        for values in figures['bands']:
+            summary.append({
+                    'group': 'band',
+                    'value': '%s %s%%' % (values['nature'] or '',
+                        values['percentage_deduction']
+                        if values['percentage_deduction'] is not None
+                        else ''),
+                    })
+        for values in figures['provinces']:
+            summary.append({
+                    'group': 'province',
+                    'value': values['party_subdivision_code'],
+                    })
+        for line, values in zip(summary, figures['natures']
+                + figures['bands'] + figures['provinces']):
+            line['donors'] = values['donors']
+            line['amount'] = values['amount']
+        return {
+            'report': report.id,
+            'donors': figures['donors'],
+            'amount': figures['amount'],
+            'summary': summary,
+            'first_donors': figures['first_donors'],
+            }
+
+
+class ReportError(ModelSQL, ModelView):
+    'AEAT 182 Report Error'
+    __name__ = 'aeat.182.report.error'
+    report = fields.Many2One('aeat.182.report', 'Report', required=True,
+        readonly=True, ondelete='CASCADE', select=True)
+    line = fields.Many2One('aeat.182.report.party', 'Line', readonly=True,
+        ondelete='CASCADE')
+    party_vat = fields.Char('Party VAT', readonly=True)
+    field = fields.Selection('get_fields', 'Field', readonly=True)
+    value = fields.Char('Value', readonly=True)
+    message = fields.Char('Message', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReportError, cls).__setup__()
+        cls._order.insert(0, ('line', 'ASC'))
+
+    @classmethod
+    def get_fields(cls):
+        ReportParty = Pool().get('aeat.182.report.party')
+        # The errors of the tasks have no field
+        return [(None, '')] + [(n, ReportParty._fields[n].string)
+            for n in ReportParty._checked_fields()]
+
+
+class ReportSummary(ModelSQL, ModelView):
+    'AEAT 182 Report Summary'
+    __name__ = 'aeat.182.report.summary'
+    report = fields.Many2One('aeat.182.report', 'Report', readonly=True)
+    nature = fields.Selection([
+            ('F', '[F]. Physical person'),
+            ('J', '[J]. Artificial person'),
+            ('E', '[E]. Entity under the income allocation'),
+            (None, ''),
+            ], 'Nature', readonly=True)
+    key = fields.Selection(KEY, 'Key', readonly=True)
+    donors = fields.Integer('Donors', readonly=True)
+    amount = fields.Numeric('Amount', digits=(16, 2), readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ReportSummary, cls).__setup__()
+        cls._order.insert(0, ('nature', 'ASC'))
+        cls._order.insert(1, ('key', 'ASC'))
+
+    @classmethod
+    def table_query(cls):
+        "Count and sum the lines of the reports by nature and key"
+        ReportParty = Pool().get('aeat.182.report.party')
+        line = ReportParty.__table__()
+        return line.select(
+            Min(line.id).as_('id'),
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            line.report.as_('report'),
+            line.nature.as_('nature'),
+            line.key.as_('key'),
+            Count(line.id).as_('donors'),
+            ReportParty.amount.sql_cast(Sum(line.amount)).as_('amount'),
+            group_by=[line.report, line.nature, line.key])
@@ -0,0 +1,46 @@
+# This file is part of aeat_182 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Subdivision', 'Zip']
+
+
+class Subdivision(metaclass=PoolMeta):
+    __name__ = 'country.subdivision'
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        records = super(Subdivision, cls).create(*args, **kwargs)
+        Pool().get('aeat.182.report')._subdivision_code_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args, **kwargs):
+        super(Subdivision, cls).write(*args, **kwargs)
+        Pool().get('aeat.182.report')._subdivision_code_cache.clear()
+
+    @classmethod
+    def delete(cls, *args, **kwargs):
+        super(Subdivision, cls).delete(*args, **kwargs)
+        Pool().get('aeat.182.report')._subdivision_code_cache.clear()
+
+
+class Zip(metaclass=PoolMeta):
+    __name__ = 'country.zip'
+
+    @classmethod
+    def create(cls, *args, **kwargs):
+        records = super(Zip, cls).create(*args, **kwargs)
+        Pool().get('aeat.182.report')._subdivision_code_cache.clear()
+        return records
+
+    @classmethod
+    def write(cls, *args, **kwargs):
+        super(Zip, cls).write(*args, **kwargs)
+        Pool().get('aeat.182.report')._subdivision_code_cache.clear()
+
+    @classmethod
+    def delete(cls, *args, **kwargs):
+        super(Zip, cls).delete(*args, **kwargs)
+        Pool().get('aeat.182.report')._subdivision_code_cache.clear()
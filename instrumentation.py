@@ -0,0 +1,144 @@
+# This file is part of aeat_182 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['count_queries', 'instrument', 'phase', 'Stats']
+logger = logging.getLogger(__name__)
+_local = threading.local()
+
+
+class _CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name in {'_cursor', '_counter'}:
+            super().__setattr__(name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+
+class _CountingConnection(object):
+    def __init__(self, connection):
+        self._connection = connection
+        self.queries = 0
+
+    def cursor(self, *args, **kwargs):
+        return _CountingCursor(
+            self._connection.cursor(*args, **kwargs), self)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+@contextmanager
+def count_queries():
+    "Count the queries executed on the connection of the transaction"
+    transaction = Transaction()
+    connection = transaction.connection
+    counter = _CountingConnection(connection)
+    transaction.connection = counter
+    try:
+        yield counter
+    finally:
+        transaction.connection = connection
+
+
+class Stats(object):
+    "Wall time, number of queries and rows of the phases of a task"
+
+    def __init__(self, name, counter):
+        self.name = name
+        self.counter = counter
+        self.phases = {}
+
+    def add(self, name, wall_time, queries, rows):
+        calls, total_time, total_queries, total_rows = self.phases.get(
+            name, (0, 0., 0, None))
+        if rows is not None:
+            total_rows = (total_rows or 0) + rows
+        self.phases[name] = (calls + 1, total_time + wall_time,
+            total_queries + queries, total_rows)
+
+    def summary(self):
+        "Return the text of the phases in the order they were started"
+        lines = []
+        for name, (calls, wall_time, queries, rows) in self.phases.items():
+            line = '%s: %.3fs, %s queries' % (name, wall_time, queries)
+            if rows is not None:
+                line += ', %s rows' % rows
+            if calls > 1:
+                line += ', %s calls' % calls
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def enabled():
+    return config.getboolean('aeat_182', 'instrument', default=False)
+
+
+@contextmanager
+def instrument(name):
+    """
+    Record the phases run inside into the yielded Stats when the
+    instrumentation is enabled, otherwise None is yielded.
+    The task is logged on exit.
+    """
+    if not enabled() or getattr(_local, 'stats', None) is not None:
+        yield None
+        return
+    with count_queries() as counter:
+        stats = _local.stats = Stats(name, counter)
+        try:
+            with phase(name):
+                yield stats
+        finally:
+            _local.stats = None
+    for line in stats.summary().splitlines():
+        logger.info('%s', line)
+
+
+@contextmanager
+def phase(name):
+    """
+    Measure the enclosed phase of the current task.
+    It yields a dictionary to set the number of rows handled.
+    """
+    stats = getattr(_local, 'stats', None)
+    result = {'rows': None}
+    if stats is None:
+        yield result
+        return
+    queries = stats.counter.queries
+    # Keep the order of the phases by their start
+    stats.phases.setdefault(name, (0, 0., 0, None))
+    start = time.perf_counter()
+    try:
+        yield result
+    finally:
+        stats.add(name, time.perf_counter() - start,
+            stats.counter.queries - queries, result['rows'])
@@ -0,0 +1,72 @@
+# This file is part of aeat_182 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+try:
+    from http import HTTPStatus
+except ImportError:
+    from http import client as HTTPStatus
+
+import os
+
+from werkzeug.exceptions import abort
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+from trytond.filestore import filestore
+from trytond.protocols.wrappers import with_pool, with_transaction
+from trytond.wsgi import app
+
+from .store import get_path, get_prefix
+
+# The file id and file name fields of the files that can be downloaded
+FILES = {
+    'file': ('file_', 'file_id', 'filename', 'text/plain'),
+    'archive': ('archive', 'archive_id', 'archive_filename',
+        'application/gzip'),
+    'certificates': ('certificates', 'certificates_id',
+        'certificates_filename', 'application/zip'),
+    'export': ('export', 'export_id', 'export_filename',
+        'application/octet-stream'),
+    }
+
+
+@app.route('/<database_name>/aeat_182/report/<int:report>/<name>',
+    methods={'GET'})
+@app.auth_required
+@with_pool
+@with_transaction(user='request', context=dict(_check_access=True))
+def download(request, pool, report, name):
+    """
+    Return the file of the report from the filestore, streamed from the disk
+    when the filestore is stored on it.
+    """
+    Report = pool.get('aeat.182.report')
+    if name not in FILES:
+        abort(HTTPStatus.NOT_FOUND)
+    field, file_id, filename, mimetype = FILES[name]
+    reports = Report.search([('id', '=', report)])
+    if not reports:
+        abort(HTTPStatus.NOT_FOUND)
+    report, = reports
+    if not getattr(report, file_id):
+        abort(HTTPStatus.NOT_FOUND)
+
+    id_ = getattr(report, file_id)
+    prefix = get_prefix(getattr(Report, field))
+    path = get_path(id_, prefix)
+    try:
+        if path is not None:
+            # Stream the file from the disk by blocks
+            file_ = open(path, 'rb')
+            size = os.fstat(file_.fileno()).st_size
+            response = Response(wrap_file(request.environ, file_),
+                mimetype=mimetype, direct_passthrough=True)
+            response.content_length = size
+        else:
+            response = Response(filestore.get(id_, prefix),
+                mimetype=mimetype)
+    except (IOError, OSError):
+        abort(HTTPStatus.NOT_FOUND)
+    response.headers.add('Content-Disposition', 'attachment',
+        filename=getattr(report, filename))
+    return response
@@ -0,0 +1,91 @@
+# This file is part of aeat_182 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import hashlib
+import io
+import os
+
+from trytond.config import config
+from trytond.filestore import filestore
+from trytond.transaction import Transaction
+
+__all__ = ['get_prefix', 'get_path', 'open_file', 'set_file']
+BUFFER_SIZE = 64 * 1024
+
+
+def get_prefix(field):
+    "Return the filestore prefix of the binary field"
+    if field.store_prefix is None:
+        return Transaction().database.name
+    return field.store_prefix
+
+
+def get_path(id, prefix):
+    """
+    Return the path of the file id in the filestore or None if the filestore
+    is not stored on the disk by trytond.
+    """
+    if config.get('database', 'class'):
+        return None
+    return filestore._filename(id, prefix)
+
+
+def open_file(id, prefix):
+    """
+    Return a binary file object with the content of the file id of the
+    filestore, opened from the disk when the filestore is stored on it.
+    """
+    path = get_path(id, prefix)
+    if path is None:
+        return io.BytesIO(filestore.get(id, prefix))
+    return open(path, 'rb')
+
+
+def set_file(file_, prefix):
+    """
+    Store the content of the file object file_ in the filestore and return
+    its id.
+    The content is read and copied by blocks, so it is never loaded in memory
+    at once unless the filestore is not stored on the disk by trytond.
+    """
+    file_.flush()
+    file_.seek(0)
+    if config.get('database', 'class'):
+        return filestore.set(file_.read(), prefix)
+
+    digest = hashlib.md5()
+    for block in iter(lambda: file_.read(BUFFER_SIZE), b''):
+        digest.update(block)
+    id_ = digest.hexdigest()
+
+    # Resolve the collisions of the id like the filestore does
+    collision = 0
+    while True:
+        filename = get_path(id_, prefix)
+        if not os.path.exists(filename):
+            break
+        if _same_content(file_, filename):
+            return id_
+        collision += 1
+        id_ = '%s-%s' % (digest.hexdigest(), collision)
+
+    dirname = os.path.dirname(filename)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname, 0o770)
+    file_.seek(0)
+    with open(filename, 'wb') as target:
+        for block in iter(lambda: file_.read(BUFFER_SIZE), b''):
+            target.write(block)
+    return id_
+
+
+def _same_content(file_, filename):
+    "Return whether the file object file_ has the content of filename"
+    file_.seek(0)
+    with open(filename, 'rb') as other:
+        while True:
+            block = file_.read(BUFFER_SIZE)
+            if block != other.read(BUFFER_SIZE):
+                return False
+            if not block:
+                return True
@@ -0,0 +1,327 @@
+# This file is part of aeat_182 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Benchmark of the AEAT 182 report workflow on synthetic data.
+
+It loads parties, donation move lines and prior year reports into the test
+database and times each phase of the report, storing the wall time, the
+number of SQL queries and the peak of Python memory in a JSON file::
+
+    DB_NAME=:memory: python -m \\
+        trytond.modules.aeat_182.tests.benchmark_aeat_182 \\
+        --parties 10000 --lines 30000 --years 2 --output benchmark.json
+
+The database is selected with the same environment variables as the
+tests (TRYTOND_DATABASE_URI and DB_NAME).
+"""
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from decimal import Decimal
+
+from trytond import __version__ as trytond_version, backend
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.currency.tests import create_currency
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.aeat_182.instrumentation import count_queries
+
+NIF_LETTERS = 'TRWAGMYFPDXBNJZSQVHLCKE'
+SUBDIVISIONS = [
+    ('ES-B', 'Barcelona', '08'),
+    ('ES-M', 'Madrid', '28'),
+    ('ES-V', 'Valencia', '46'),
+    ('ES-SE', 'Sevilla', '41'),
+    ('ES-Z', 'Zaragoza', '50'),
+    ('ES-BI', 'Bizkaia', '48'),
+    ('ES-GI', 'Girona', '17'),
+    ('ES-T', 'Tarragona', '43'),
+    ]
+BATCH = 1000
+
+
+class Benchmark(object):
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.results = []
+
+    @contextmanager
+    def measure(self, name):
+        "Measure the enclosed phase, it yields a dictionary to set rows"
+        result = {'name': name, 'rows': None}
+        if self.memory:
+            tracemalloc.start()
+        try:
+            with count_queries() as counter:
+                start = time.perf_counter()
+                yield result
+                result['wall_time'] = time.perf_counter() - start
+            result['queries'] = counter.queries
+            if self.memory:
+                _, result['peak_memory'] = tracemalloc.get_traced_memory()
+            else:
+                result['peak_memory'] = None
+        finally:
+            if self.memory:
+                tracemalloc.stop()
+        self.results.append(result)
+        print('%(name)-20s %(wall_time)10.3fs %(queries)8d queries '
+            '%(rows)8s rows' % result, file=sys.stderr)
+
+
+def explain(query):
+    "Return the scan nodes of the plan of query"
+    cursor = Transaction().connection.cursor()
+    sql, params = tuple(query)
+    if backend.name == 'postgresql':
+        cursor.execute('EXPLAIN ' + sql, params)
+        return [r[0].strip(' ->') for r in cursor.fetchall()
+            if 'Scan' in r[0]]
+    else:
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [r[-1] for r in cursor.fetchall()]
+
+
+def nif(number):
+    return '%08d%s' % (number, NIF_LETTERS[number % 23])
+
+
+def create_subdivisions():
+    pool = Pool()
+    Country = pool.get('country.country')
+    Subdivision = pool.get('country.subdivision')
+    Zip = pool.get('country.zip')
+
+    country, = Country.create([{'name': 'Spain', 'code': 'ES'}])
+    subdivisions = Subdivision.create([{
+                'country': country.id,
+                'name': name,
+                'code': code,
+                'type': 'province',
+                } for code, name, _ in SUBDIVISIONS])
+    Zip.create([{
+                'country': country.id,
+                'subdivision': subdivision.id,
+                'zip': '%s%03d' % (prefix, i),
+                } for subdivision, (_, _, prefix) in zip(
+                subdivisions, SUBDIVISIONS)
+            for i in range(1, 100)])
+    return country, subdivisions
+
+
+def create_parties(number, country, subdivisions):
+    "Create number of donors mixing persons and organizations"
+    Party = Pool().get('party.party')
+
+    party_ids = []
+    for start in range(0, number, BATCH):
+        vlist = []
+        for i in range(start, min(start + BATCH, number)):
+            address = {'country': country.id}
+            if i % 10:
+                address['subdivision'] = subdivisions[
+                    i % len(subdivisions)].id
+            vlist.append({
+                    'name': 'Donor %s' % i,
+                    'party_type': 'organization' if i % 5 == 0 else 'person',
+                    'identifiers': [('create', [{
+                                    'type': 'eu_vat',
+                                    'code': 'ES' + nif(i + 1),
+                                    }])],
+                    'addresses': [('create', [address])],
+                    })
+        party_ids.extend(p.id for p in Party.create(vlist))
+    return party_ids
+
+
+def create_donations(fiscalyear, accounts, counterpart, party_ids, number,
+        rng):
+    "Create number of donation lines over accounts spread on fiscalyear"
+    pool = Pool()
+    Journal = pool.get('account.journal')
+    Move = pool.get('account.move')
+
+    journal, = Journal.search([('code', '=', 'REV')])
+    periods = fiscalyear.periods
+    for start in range(0, number, BATCH):
+        period = periods[(start // BATCH) % len(periods)]
+        lines = []
+        total = Decimal(0)
+        for _ in range(start, min(start + BATCH, number)):
+            amount = Decimal(rng.randrange(500, 60000)) / 100
+            total += amount
+            lines.append({
+                    'account': rng.choice(accounts).id,
+                    'party': rng.choice(party_ids),
+                    'credit': amount,
+                    'debit': Decimal(0),
+                    })
+        lines.append({
+                'account': counterpart.id,
+                'debit': total,
+                'credit': Decimal(0),
+                })
+        Move.create([{
+                    'period': period.id,
+                    'journal': journal.id,
+                    'date': period.start_date,
+                    'lines': [('create', lines)],
+                    }])
+
+
+def create_report(company, fiscalyear, accounts):
+    Report = Pool().get('aeat.182.report')
+    report, = Report.create([{
+                'company': company.id,
+                'company_vat': '00000000T',
+                'fiscalyear': fiscalyear.id,
+                'fiscalyear_code': fiscalyear.start_date.year,
+                'presentation': 'printed',
+                'declarant_nature': '1',
+                'type': 'N',
+                'accounts': [('add', [a.id for a in accounts])],
+                }])
+    return report
+
+
+def setup(parties, lines, years, accounts, seed):
+    "Load the synthetic data and return the report to benchmark"
+    pool = Pool()
+    Account = pool.get('account.account')
+    FiscalYear = pool.get('account.fiscalyear')
+    Report = pool.get('aeat.182.report')
+
+    rng = random.Random(seed)
+    currency = create_currency('EUR')
+    company = create_company(currency=currency)
+    with set_company(company):
+        create_chart(company)
+        receivable, = Account.search([
+                ('type.receivable', '=', True),
+                ('company', '=', company.id),
+                ], limit=1)
+        revenue, = Account.search([
+                ('type.revenue', '=', True),
+                ('company', '=', company.id),
+                ], limit=1)
+        donation_accounts = Account.create([{
+                    'name': 'Donation %s' % i,
+                    'type': receivable.type.id,
+                    'reconcile': True,
+                    'party_required': True,
+                    } for i in range(accounts)])
+
+        country, subdivisions = create_subdivisions()
+        party_ids = create_parties(parties, country, subdivisions)
+
+        current_year = datetime.date.today().year
+        report = None
+        for year in range(current_year - years, current_year + 1):
+            fiscalyear = get_fiscalyear(
+                company, today=datetime.date(year, 1, 1))
+            fiscalyear.save()
+            FiscalYear.create_period([fiscalyear])
+            create_donations(fiscalyear, donation_accounts, revenue,
+                party_ids, lines, rng)
+            report = create_report(company, fiscalyear, donation_accounts)
+            if year != current_year:
+                Report.calculate([report])
+                Report.process([report])
+    return company, report
+
+
+def run(benchmark, company, report_id, plan=False):
+    pool = Pool()
+    Report = pool.get('aeat.182.report')
+
+    with set_company(company):
+        report = Report(report_id)
+        if plan:
+            query = report.get_report_parties_query(report.fiscalyear)
+            for node in explain(query):
+                print('get_report_parties plan: %s' % node, file=sys.stderr)
+        with benchmark.measure('get_report_parties') as result:
+            report_parties = report.get_report_parties(report.fiscalyear)
+            result['rows'] = len(report_parties)
+
+        amounts = {}
+        for report_party in report_parties:
+            amounts[report_party['party_vat']] = report_party['amount']
+        report = Report(report_id)
+        with benchmark.measure('pluriannual') as result:
+            vats = report.get_pluriannual_vats(amounts)
+            result['rows'] = len(vats)
+
+        with benchmark.measure('calculate') as result:
+            Report.calculate([Report(report_id)])
+
+        report = Report(report_id)
+        names = ['total_number_of_donor_records', 'amount_of_donations',
+            'total_sheets']
+        with benchmark.measure('get_totals') as result:
+            totals = Report.get_totals([report], names)
+            result['rows'] = totals['total_number_of_donor_records'][
+                report_id]
+
+        report = Report(report_id)
+        with benchmark.measure('create_file') as result:
+            report.create_file()
+            result['rows'] = totals['total_number_of_donor_records'][
+                report_id]
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--parties', type=int, default=1000,
+        help="number of donors")
+    parser.add_argument('--lines', type=int, default=3000,
+        help="number of donation lines per fiscal year")
+    parser.add_argument('--years', type=int, default=2,
+        help="number of prior years with a calculated report")
+    parser.add_argument('--accounts', type=int, default=2,
+        help="number of donation accounts")
+    parser.add_argument('--seed', type=int, default=182)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+        help="do not trace memory as it slows down the execution")
+    parser.add_argument('--explain', action='store_true',
+        help="print the plan of the aggregation of the donation lines")
+    parser.add_argument('--output', default='benchmark_aeat_182.json',
+        help="JSON file to store the results")
+    options = parser.parse_args(arguments)
+
+    activate_module('aeat_182')
+    benchmark = Benchmark(memory=options.memory)
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        company, report = setup(options.parties, options.lines,
+            options.years, options.accounts, options.seed)
+        transaction.commit()
+        run(benchmark, company, report.id, plan=options.explain)
+        transaction.rollback()
+
+    with open(options.output, 'w') as output:
+        json.dump({
+                'date': datetime.datetime.now().isoformat(),
+                'trytond': trytond_version,
+                'backend': backend.name,
+                'parameters': {
+                    'parties': options.parties,
+                    'lines': options.lines,
+                    'years': options.years,
+                    'accounts': options.accounts,
+                    'seed': options.seed,
+                    },
+                'results': benchmark.results,
+                }, output, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# This file is part of aeat_182 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Micro benchmark of the conversion of the AEAT 182 file to the AEAT charset.
+
+It compares the translation tables against the previous implementation
+based on NFD normalization on a generated file of the given size::
+
+    python -m trytond.modules.aeat_182.tests.benchmark_charset --size 5
+"""
+import argparse
+import random
+import timeit
+import unicodedata
+
+from trytond.modules.aeat_182.aeat import aeat_encode
+
+NAMES = ['Peña', 'Muñoz', 'Gonçalves', 'Ibáñez', 'Álvarez', 'Núñez',
+    'Sánchez', 'Güell', 'Fundació', 'Associació', 'Castellà', 'Martínez']
+
+
+def nfd_remove_accents(unicode_string):
+    "Previous implementation, it removes also the accents of ñ and ç"
+    unicode_string_nfd = ''.join(
+        (c for c in unicodedata.normalize('NFD', unicode_string)
+            if (unicodedata.category(c) != 'Mn'
+                or c in ('\\u0327', '\\u0303'))
+            ))
+    return unicodedata.normalize('NFC', unicode_string_nfd)
+
+
+def generate(size):
+    "Return a text of about size bytes with records of 250 characters"
+    rng = random.Random(182)
+    lines = []
+    length = 0
+    while length < size:
+        name = ' '.join(rng.choice(NAMES) for _ in range(3))
+        line = ('2182%04d%-9s%-9s%-40s' % (2020, '00000000T', '00000001R',
+                name[:40])).ljust(248) + '\r\n'
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=float, default=5,
+        help="size of the file in megabytes")
+    parser.add_argument('--number', type=int, default=3,
+        help="number of executions")
+    options = parser.parse_args(arguments)
+
+    data = generate(int(options.size * 1024 * 1024))
+    previous = timeit.timeit(
+        lambda: nfd_remove_accents(data).upper().encode('iso-8859-1'),
+        number=options.number) / options.number
+    current = timeit.timeit(
+        lambda: aeat_encode(data),
+        number=options.number) / options.number
+    print('size: %.1f MB' % (len(data) / 1024 / 1024))
+    print('previous: %.3fs' % previous)
+    print('current: %.3fs' % current)
+    print('speedup: %.1fx' % (previous / current))
+
+
+if __name__ == '__main__':
+    main()
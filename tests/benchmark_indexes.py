@@ -0,0 +1,117 @@
+# This file is part of aeat_182 module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Benchmark of the donor history lookup of the pluriannual deduction.
+
+It fills the donor history of the prior years with the given number of rows
+and shows the query plan and the time of get_pluriannual_vats for a sample
+of donors with and without the unique index of the donor history::
+
+    python -m trytond.modules.aeat_182.tests.benchmark_indexes \\
+        --rows 1000000
+
+The database is selected with the same environment variables as the
+tests (TRYTOND_DATABASE_URI and DB_NAME), the plans are only meaningful on
+PostgreSQL.
+"""
+import argparse
+import time
+from decimal import Decimal
+
+from sql.functions import CurrentTimestamp
+
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+from trytond.tools import grouped_slice
+from trytond.modules.company.tests import set_company
+from trytond.modules.aeat_182.tests.benchmark_aeat_182 import (
+    explain, nif, setup)
+
+# Constraint dropped to compare the lookup without its index
+CONSTRAINT = 'aeat_182_donor_history_party_vat_uniq'
+
+
+def fill(company, years, rows):
+    "Insert rows of donor history of company spread over years"
+    pool = Pool()
+    DonorHistory = pool.get('aeat.182.donor.history')
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    history = DonorHistory.__table__()
+
+    DonorHistory.delete(DonorHistory.search([]))
+    values = ((years[i % len(years)], nif(i // len(years) + 1),
+            Decimal(i % 500 + 1)) for i in range(rows))
+    for sub_values in grouped_slice(values, 1000):
+        cursor.execute(*history.insert(
+                [history.create_uid, history.create_date, history.company,
+                    history.party_vat, history.fiscalyear_code,
+                    history.amount],
+                [[transaction.user, CurrentTimestamp(), company.id, v, y, a]
+                    for y, v, a in sub_values]))
+    cursor.execute('ANALYZE')
+
+
+def measure(report, amounts, number):
+    "Return the best time of number executions of the lookup of amounts"
+    best = None
+    for _ in range(number):
+        start = time.perf_counter()
+        report.get_pluriannual_vats(amounts)
+        duration = time.perf_counter() - start
+        best = duration if best is None else min(best, duration)
+    return best
+
+
+def print_lookup(report, amounts, number):
+    print('get_pluriannual_vats: %.4fs' % measure(report, amounts, number))
+    for query in report.get_pluriannual_queries(
+            list(amounts), report.get_previous_fiscalyear_codes(), []):
+        for node in explain(query):
+            print('    %s' % node)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--rows', type=int, default=1000000,
+        help="number of donor history rows")
+    parser.add_argument('--years', type=int, default=9,
+        help="number of prior years")
+    parser.add_argument('--sample', type=int, default=200,
+        help="number of donors looked up")
+    parser.add_argument('--number', type=int, default=5,
+        help="number of executions")
+    options = parser.parse_args(arguments)
+
+    activate_module('aeat_182')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT) as transaction:
+        pool = Pool()
+        Report = pool.get('aeat.182.report')
+        company, report = setup(10, 10, options.years, 1, 182)
+        with set_company(company):
+            report = Report(report.id)
+            years = [report.fiscalyear_code - i
+                for i in range(1, options.years + 1)]
+            fill(company, years, options.rows)
+            donors = max(options.rows // len(years), 1)
+            amounts = {nif(i + 1): Decimal(500)
+                for i in range(0, donors, max(donors // options.sample, 1))
+                }
+            amounts = dict(list(amounts.items())[:options.sample])
+
+            print('With index')
+            print_lookup(report, amounts, options.number)
+
+            cursor = transaction.connection.cursor()
+            cursor.execute('ALTER TABLE "%s" DROP CONSTRAINT IF EXISTS "%s"'
+                % (pool.get('aeat.182.donor.history')._table, CONSTRAINT))
+            cursor.execute('ANALYZE')
+            print('Without index')
+            print_lookup(report, amounts, options.number)
+        transaction.rollback()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,16 @@
 # the full copyright notices and license terms.
 import unittest
 import doctest
+import tempfile
 import trytond.tests.test_tryton
-from trytond.tests.test_tryton import ModuleTestCase
+from trytond.config import config
+from trytond.filestore import filestore
+from trytond.pool import Pool
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+from trytond.modules.aeat_182.aeat import aeat_encode, remove_accents
+from trytond.modules.aeat_182.instrumentation import instrument, phase
+from trytond.modules.aeat_182.store import set_file
 from trytond.tests.test_tryton import doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
 
@@ -13,6 +21,136 @@ class Aeat182TestCase(ModuleTestCase):
     'Test Aeat 182 module'
     module = 'aeat_182'
 
+    def test_remove_accents(self):
+        'Test remove accents'
+        self.assertEqual(remove_accents('Peña Gonçalves Ibáñez Güell'),
+            'Peña Gonçalves Ibañez Guell')
+        self.assertEqual(remove_accents('PEÑA ÇÀÉÏÔÚ'), 'PEÑA ÇAEIOU')
+        self.assertEqual(remove_accents('Łódź 10€ @ «x»'), ' odz 10     x ')
+        self.assertEqual(remove_accents("O'Neill & Co., S.L."),
+            "O'Neill & Co., S.L.")
+
+    def test_aeat_encode(self):
+        'Test AEAT encode'
+        self.assertEqual(aeat_encode('Peña Gonçalves Ibáñez\r\n'),
+            'PEÑA GONÇALVES IBAÑEZ\r\n'.encode('iso-8859-1'))
+        self.assertEqual(aeat_encode('Fundació l·l'),
+            'FUNDACIO L L'.encode('iso-8859-1'))
+
+    def test_set_file(self):
+        'Test set file'
+        data = b'AEAT 182' * 10000
+        with tempfile.TemporaryFile() as file_:
+            file_.write(data)
+            id_ = set_file(file_, 'aeat_182_test')
+            self.assertEqual(set_file(file_, 'aeat_182_test'), id_)
+        self.assertEqual(filestore.get(id_, 'aeat_182_test'), data)
+        self.assertEqual(filestore.set(data, 'aeat_182_test'), id_)
+
+    @with_transaction()
+    def test_instrument(self):
+        'Test instrument'
+        pool = Pool()
+        Subdivision = pool.get('country.subdivision')
+        subdivision = Subdivision.__table__()
+
+        def execute():
+            with instrument('task') as stats:
+                with phase('select') as result:
+                    cursor = Transaction().connection.cursor()
+                    cursor.arraysize = 10
+                    self.assertEqual(
+                        getattr(cursor, '_cursor', cursor).arraysize, 10)
+                    cursor.execute(*subdivision.select(subdivision.id))
+                    cursor.execute(*subdivision.select(subdivision.code))
+                    result['rows'] = len(cursor.fetchall())
+            return stats
+
+        self.assertIsNone(execute())
+
+        if not config.has_section('aeat_182'):
+            config.add_section('aeat_182')
+        config.set('aeat_182', 'instrument', 'True')
+        self.addCleanup(config.remove_option, 'aeat_182', 'instrument')
+        stats = execute()
+        calls, _, queries, rows = stats.phases['select']
+        self.assertEqual((calls, queries, rows),
+            (1, 2, Subdivision.search_count([])))
+        self.assertEqual(stats.phases['task'][2], 2)
+        self.assertIn('select: ', stats.summary())
+
+    @with_transaction()
+    def test_subdivision_codes(self):
+        'Test subdivision codes'
+        pool = Pool()
+        Country = pool.get('country.country')
+        Subdivision = pool.get('country.subdivision')
+        Zip = pool.get('country.zip')
+        Report = pool.get('aeat.182.report')
+
+        # Warm the cache to check the changes below invalidate it
+        Report.get_subdivision_codes()
+
+        spain, france = Country.create([
+                {'name': 'Spain', 'code': 'ES'},
+                {'name': 'France', 'code': 'FR'},
+                ])
+        barcelona, asturias, unknown, paris = Subdivision.create([{
+                    'country': spain.id,
+                    'name': 'Barcelona',
+                    'code': 'ES-B',
+                    'type': 'province',
+                    }, {
+                    'country': spain.id,
+                    'name': 'Asturias',
+                    'code': 'ES-AS',
+                    'type': 'autonomous community',
+                    }, {
+                    'country': spain.id,
+                    'name': 'Unknown',
+                    'code': 'ES-XX',
+                    'type': 'province',
+                    }, {
+                    'country': france.id,
+                    'name': 'Paris',
+                    'code': 'FR-75',
+                    'type': 'metropolitan department',
+                    }])
+
+        codes = Report.get_subdivision_codes()
+        self.assertEqual(codes[(spain.id, barcelona.id)], '08')
+        self.assertEqual(codes[(spain.id, asturias.id)], '33')
+        self.assertNotIn((spain.id, unknown.id), codes)
+        self.assertNotIn((france.id, paris.id), codes)
+
+        Subdivision.write([unknown], {'code': 'ES-5'})
+        codes = Report.get_subdivision_codes()
+        self.assertEqual(codes[(spain.id, unknown.id)], '05')
+
+        Subdivision.write([unknown], {'code': 'ES-XX'})
+        codes = Report.get_subdivision_codes()
+        self.assertNotIn((spain.id, unknown.id), codes)
+
+        zip_, = Zip.create([{
+                    'country': spain.id,
+                    'subdivision': unknown.id,
+                    'zip': '17001',
+                    }])
+        codes = Report.get_subdivision_codes()
+        self.assertEqual(codes[(spain.id, unknown.id)], '17')
+
+        Zip.write([zip_], {'zip': '25001'})
+        codes = Report.get_subdivision_codes()
+        self.assertEqual(codes[(spain.id, unknown.id)], '25')
+
+        Zip.delete([zip_])
+        codes = Report.get_subdivision_codes()
+        self.assertNotIn((spain.id, unknown.id), codes)
+
+        Subdivision.delete([unknown])
+        codes = Report.get_subdivision_codes()
+        self.assertNotIn((spain.id, unknown.id), codes)
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()